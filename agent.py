@@ -1,9 +1,19 @@
+import copy
 import time
+import threading
 import numpy as np
 from typing import Tuple, List
-from copy import deepcopy
 
 from grid import Grid
+from generator import Generator
+from rollout import RolloutEngine, RolloutPolicy, LeafValueCache
+from instrumentation import Instrumentation
+from belief import BeliefUpdater, ParticleBelief, uniform_belief, particles_from_belief
+from tree import ArrayTree, History, NO_NODE, best_tried_action, hash_history
+from rng import UniformBlock, make_rng, spawn_rngs, spawn_seeds
+from plan_cache import PlanCache
+from kernel import SearchKernel, NUMBA_AVAILABLE
+from parallel import RootParallelSearch, TreeParallelSearch, merge_root_statistics
 
 """
 * A belief is probability distribution over states
@@ -12,20 +22,12 @@ from grid import Grid
 """
 
 class Node(object):
-    def __init__(
-        self,
-        action: str=None, # None for none action nodes
-        parent=None,
-        value: float=0.,
-        nb_visits: int=0,
-        history: List=[],
-    ):
-        self.action = action
-        self.parent = parent
-        self.value = value
-        self.nb_visits = nb_visits
-        self.history = history
-        self.children = []
+    """
+    Read-only view over one node of the array-backed search tree
+    """
+    def __init__(self, tree: ArrayTree, index: int):
+        self.tree = tree
+        self.index = index
 
     def __str__(self) -> str:
         return f"Node({self.nb_visits}, {self.value}, {len(self.history)}, {len(self.children)})"
@@ -33,8 +35,44 @@ class Node(object):
     def __repr__(self) -> str:
         return self.__str__()
 
-    def add_child(self, child):
-        self.children.append(child)
+    @property
+    def action(self) -> int:
+        action = int(self.tree.action[self.index])
+        return None if action == NO_NODE else action
+
+    @property
+    def value(self) -> float:
+        return float(self.tree.value[self.index])
+
+    @property
+    def nb_visits(self) -> int:
+        return int(self.tree.nb_visits[self.index])
+
+    @property
+    def parent(self):
+        parent = int(self.tree.parent[self.index])
+        return None if parent == NO_NODE else Node(self.tree, parent)
+
+    @property
+    def children(self) -> List:
+        if self.is_action_node:
+            children = self.tree.observation_children[self.index]
+            return [Node(self.tree, int(child)) for child in children[children != NO_NODE]]
+        children = self.tree.action_children[self.index]
+        return [Node(self.tree, int(child)) for child in children[children != NO_NODE]]
+
+    @property
+    def history(self) -> List:
+        """
+        Rebuilt by walking up to the root (debugging only)
+        """
+        history = []
+        node = self
+        while node.parent is not None:
+            label = node.action if node.is_action_node else int(self.tree.observation[node.index])
+            history.append(label)
+            node = node.parent
+        return history[::-1]
 
     @property
     def is_action_node(self):
@@ -56,37 +94,78 @@ class Node(object):
     def get_nb_visits(self) -> int:
         return self.nb_visits
 
+    @property
+    def get_particles(self) -> ParticleBelief:
+        return self.tree.get_particles(self.index)
+
 class SearchTree(object):
-    def __init__(self, root: Node) -> None:
-        self.root = root
-        self.current_node = root
+    """
+    History-free search tree backed by an ArrayTree.
+    * Nodes are integer ids, Node gives a view over one of them.
+    * Histories are looked up through their hash in O(1).
+    """
+    def __init__(
+        self,
+        n_actions: int,
+        n_observations: int,
+        capacity: int=1024,
+        max_nodes: int=None,
+        max_observation_children: int=None,
+        max_particles: int=None,
+        uniforms: UniformBlock=None,
+    ) -> None:
+        self.tree = ArrayTree(n_actions, n_observations, capacity, max_nodes,
+                              max_observation_children=max_observation_children,
+                              max_particles=max_particles, uniforms=uniforms)
+
+    def find(self, history: List) -> int:
+        """
+        Returns the node holding this history, NO_NODE if it is not in the tree
+        """
+        return self.tree.find(hash_history(history))
 
     def is_in_tree(self, history: List) -> bool:
-        def is_in_tree_from_node(node: Node) -> bool:    
-            if node.get_history == history:
-                return True
-            for child in node.get_children:
-                if is_in_tree_from_node(child):
-                    return True
-            return False
+        return self.find(history) != NO_NODE
+
+    def add_observation_node(self, history: List) -> int:
+        action_node = self.find(history[:-1])
+        if action_node == NO_NODE:
+            return NO_NODE
+        return self.tree.add_observation_child(action_node, history[-1])
+
+    def reset(self, history: List) -> None:
+        """
+        Drops the whole tree and starts a new one at this history
+        """
+        self.tree.clear(hash_history(history))
+
+    def prune(self, node: int) -> int:
+        """
+        Re-roots the tree at node, the (action, observation) child
+        reached by the real step, and frees its siblings.
+        Returns the number of simulations reused.
+        """
+        return self.tree.reroot(node)
 
-        if self.root.get_history == history:
-            return True
-        for child in self.root.get_children:
-            if is_in_tree_from_node(child):
-                return True
-        return False
+    def node(self, index: int) -> Node:
+        return Node(self.tree, index)
 
-    def prune(self, node: Node):
-        pass
+    @property
+    def root(self) -> int:
+        return self.tree.root
 
     @property
     def get_root(self) -> Node:
-        return self.root
+        return self.node(self.tree.root)
 
     @property
     def get_current_node(self) -> Node:
-        return self.current_node
+        return self.get_root
+
+# Simulations between two early stopping checks
+EARLY_STOPPING_PERIOD = 32
+# Simulations per search kernel call
+KERNEL_BATCH = 8*EARLY_STOPPING_PERIOD
 
 class POMCPAgent(object):
     """
@@ -94,152 +173,544 @@ class POMCPAgent(object):
     def __init__(
         self,
         env: Grid,
-        initial_state: Node=Node(),
         time_out: float=30,
         discount_factor: int=0.99,
         init_belief: List=None,
         ucb_cst:float=np.sqrt(2),
         max_depth: int=5,
+        nb_particles: int=1000,
+        max_rejection_tries: int=10000,
+        max_nodes: int=None,
+        nb_workers: int=1,
+        parallel: str="root",
+        seed: int=None,
+        nb_rollouts: int=1,
+        rollout_policy: RolloutPolicy=None,
+        leaf_cache: LeafValueCache=None,
+        plan_cache: PlanCache=None,
+        instrumentation: Instrumentation=None,
+        max_simulations: int=None,
+        early_stopping: bool=False,
+        kernel: bool=None,
+        action_widening: Tuple[float, float]=None,
+        observation_widening: Tuple[float, float]=None,
+        max_observation_children: int=None,
+        verbose: bool=True,
     ):
         """
         * The initial belief is uniform.
         * Note that there is no x and y because
         the agent does not know where it is.
         * It has just a belief over states.
+        * nb_particles: size of the root particle set, and most particles
+        kept per tree node (reservoir sampled).
+        * nb_workers > 1 enables parallel search, parallel is
+        "root" (worker processes) or "tree" (threads with virtual loss).
+        * nb_rollouts playouts of rollout_policy (uniform by default)
+        are averaged at every leaf.
+        * leaf_cache: optional cache of leaf values per (state, remaining
+        depth), kept across decisions.
+        * plan_cache: optional root statistics per belief, warm-starting
+        or skipping the searches from beliefs planned for before.
+        * instrumentation: optional per-phase timers, None adds no work.
+        * The search stops at time_out or after max_simulations, the first
+        reached (None for no simulation budget).
+        * early_stopping: also stop once the most visited root action
+        cannot be overtaken within the remaining budget.
+        * kernel: run the simulations in the iterative search kernel, None
+        when Numba is installed. Needs the uniform rollout policy, and no
+        leaf cache, instrumentation or tree parallelization.
+        * action_widening: (k, alpha), a node with N visits tries a new
+        action while it has at most k*N^alpha action children, None
+        tries all the actions at once.
+        * observation_widening: (k, alpha), an action node with N visits
+        opens a new observation branch while it has at most k*N^alpha,
+        otherwise the simulation goes on in an existing branch drawn in
+        proportion to its visits. None opens one per observation.
+        * max_observation_children: observation branches per action node,
+        a new observation evicts the least visited branch past it and
+        reuses its nodes. Not supported by tree parallelization.
+        * seed: int, SeedSequence or Generator, seeds every draw of the agent:
+        simulator, rollout policy, particles and parallel workers.
+        * verbose: print planning progress
         """
         self.env = env
         self.discout_factor = discount_factor
         self.time_out = time_out
+        self.max_simulations = max_simulations
+        self.early_stopping = early_stopping
+        # Set from another thread to stop the running search
+        self.stop_event = threading.Event()
         self.ucb_cst = ucb_cst
         self.max_depth = max_depth
+        self.nb_particles = nb_particles
+        self.max_rejection_tries = max_rejection_tries
+        self.max_nodes = max_nodes
+        self.nb_workers = nb_workers
+        self.parallel = parallel
+        if nb_workers > 1 and parallel == "tree" \
+                and (action_widening is not None or observation_widening is not None):
+            raise ValueError("Progressive widening is not supported by tree parallelization.")
+        if nb_workers > 1 and parallel == "tree" and max_observation_children is not None:
+            # Evicted nodes are reused while other threads may still be below them
+            raise ValueError("max_observation_children is not supported by tree parallelization.")
+        self.action_widening = action_widening
+        self.observation_widening = observation_widening
+        self.max_observation_children = max_observation_children
+        self.seed = seed
+        self.verbose = verbose
+        self.rng = make_rng(seed)
+        # Particle draws of the search loop
+        self.uniforms = UniformBlock(self.rng)
+        self.parallel_search = None
+        self.instrumentation = instrumentation
+        self.plan_cache = plan_cache
         self.total_reward = 0
-        
+        self.last_reward = 0
+        self.done = False
+        self.reused_simulations = 0
+        # Simulations run by the last search
+        self.nb_simulations = 0
+
         # belief starts as a uniform distribution over states
         self.previous_belief = None
-        if init_belief:
-            self.current_belief = init_belief
+        if init_belief is not None:
+            self.current_belief = np.asarray(init_belief, dtype=np.float64)
         else:
-            self.current_belief = [
-                1/self.env.get_number_states for _ in range(self.env.get_number_states)
-            ]
+            self.current_belief = uniform_belief(self.env.get_number_states)
 
-        self.possible_actions = self.env.possible_actions
+        self.transition_model = self.env.transition_model
+        self.observation_model = self.env.observation_model
+        self.belief_updater = BeliefUpdater(self.transition_model, self.observation_model)
+        self.pomdp_model = self.env.pomdp_model
+        self.generator = Generator(self.pomdp_model, self.rng)
 
-        # Sequence of tuples (action, observation)
-        # The agent own history
-        self.history = []
-        self.search_tree = SearchTree(initial_state)
+        self.possible_actions = self.env.possible_actions
+        if rollout_policy is None:
+            rollout_policy = RolloutPolicy(len(self.possible_actions), self.rng)
+        if leaf_cache is not None:
+            # Refresh draws follow the agent seed
+            leaf_cache.set_rng(spawn_rngs(self.rng, 1)[0])
+        self.rollout_engine = RolloutEngine(
+            self.generator,
+            rollout_policy,
+            self.discout_factor,
+            self.max_depth,
+            nb_rollouts,
+            self.pomdp_model.terminal_states,
+            leaf_cache,
+        )
+
+        self.use_kernel = NUMBA_AVAILABLE if kernel is None else kernel
+        if self.use_kernel and (leaf_cache is not None or instrumentation is not None
+                                or type(rollout_policy) is not RolloutPolicy
+                                or (nb_workers > 1 and parallel == "tree")):
+            if kernel:
+                raise ValueError("The search kernel needs the uniform rollout policy, "
+                                 "no leaf cache, no instrumentation and no tree parallelization.")
+            self.use_kernel = False
+        self.search_kernel = self.make_kernel() if self.use_kernel else None
+
+        # Flat sequence of (action, observation) indices
+        # The agent own history, hashed incrementally
+        self.history = History()
+        self.search_tree = self.make_search_tree()
+
+    def __getstate__(self):
+        """
+        Copy sent to search workers: no environment, tree or worker pool
+        * Objects derived from the POMDP model are rebuilt on arrival,
+        so a memory-mapped model is sent as its path only
+        """
+        state = self.__dict__.copy()
+        for name in ("env", "search_tree", "parallel_search", "stop_event",
+                     "transition_model", "observation_model", "belief_updater", "generator", "search_kernel"):
+            state[name] = None
+        rollout_engine = copy.copy(self.rollout_engine)
+        rollout_engine.simulator = rollout_engine.terminal_states = None
+        state["rollout_engine"] = rollout_engine
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.transition_model = self.pomdp_model.get_transition_model
+        self.observation_model = self.pomdp_model.get_observation_model
+        self.belief_updater = BeliefUpdater(self.transition_model, self.observation_model)
+        self.generator = Generator(self.pomdp_model, self.rng)
+        self.rollout_engine.simulator = self.generator
+        self.rollout_engine.terminal_states = self.pomdp_model.terminal_states
+        self.search_kernel = self.make_kernel() if self.use_kernel else None
+
+    def make_search_tree(self) -> SearchTree:
+        return SearchTree(len(self.possible_actions), self.pomdp_model.get_nb_observations,
+                          max_nodes=self.max_nodes, max_observation_children=self.max_observation_children,
+                          max_particles=self.nb_particles, uniforms=self.uniforms)
+
+    def make_kernel(self) -> SearchKernel:
+        return SearchKernel(self.generator, self.pomdp_model.terminal_states, self.discout_factor,
+                            self.max_depth, self.ucb_cst, self.rollout_engine.nb_rollouts,
+                            self.action_widening, self.observation_widening)
 
     def update_belief(self, action: str, observation: Tuple):
         """
         Bayes theorem update
         SE: state estimator
         """
-        self.previous_belief = deepcopy(self.current_belief)
-        action = self.env.action_str2int(action)
-        for state_i in range(self.env.get_number_states):
-            numerator = sum(
-                self.observation_model.get_observation_prob(action, state_i, observation)*
-                self.transition_model.get_transition_prob(state_j, action, state_i)*
-                self.previous_belief[state_i]
-                for state_j in range(self.env.get_number_states)
-            )
-            denominator = sum(
-                self.previous_belief[state_j]*
-                sum(
-                    self.transition_model.get_transition_prob(state_j, action, state_k)*
-                    self.observation_model.get_observation_prob(action, state_k, observation)
-                    for state_k in range(self.env.get_number_states)
-                )
-                for state_j in range(self.env.get_number_states)
+        self.previous_belief = self.current_belief
+        self.current_belief = self.belief_updater.update(
+            self.current_belief,
+            self.env.action_str2int(action),
+            self.env.observation2int(observation),
+        )
+
+    def update_particles(self, previous: ParticleBelief, action: int, observation: int) -> ParticleBelief:
+        """
+        Rejection sampling: keep the simulated successors of the previous
+        particles that produced the real observation.
+        Reinvigorates from the exact belief when the set runs out.
+        """
+        root = self.search_tree.find(self.history)
+        if root == NO_NODE:
+            root = self.search_tree.add_observation_node(self.history)
+        if root == NO_NODE:
+            self.search_tree.reset(self.history)
+            root = self.search_tree.root
+        particles = self.search_tree.tree.get_particles(root)
+        tries = 0
+        while len(previous) > 0 and len(particles) < self.nb_particles \
+                and tries < self.max_rejection_tries:
+            tries += 1
+            next_state, next_obs, _ = self.generator(previous.sample(self.uniforms), action)
+            if next_obs == observation:
+                particles.add(next_state)
+        if len(particles) < self.nb_particles:
+            particles.extend(
+                particles_from_belief(self.current_belief, self.nb_particles - len(particles), self.rng).get_particles
             )
-            self.current_belief[state_i] = numerator/denominator
+        return particles
+
+    def sample_state_from_belief(self) -> int:
+        return int(self.rng.choice(len(self.current_belief), p=self.current_belief))
 
-    def sample_state_from_belief(self) -> float:
-        return np.random.choice(len(self.current_belief), p=self.current_belief)
+    def check_model(self) -> None:
+        """
+        Raises when the environment no longer has the model the agent
+        was built with, e.g. after env.reset() drew a new layout
+        """
+        if self.env is not None and self.env.pomdp_model is not self.pomdp_model:
+            raise ValueError("The environment model changed since the agent was built, "
+                             "build a new agent for the new model.")
 
-    def search(self, history):
+    def search(self, history, time_out: float=None, max_simulations: int=None):
+        """
+        Anytime search from the node of history.
+        * time_out, max_simulations: override the agent budgets
+        Returns the index of the best action.
+        """
+        self.check_model()
+        time_out = self.time_out if time_out is None else time_out
+        max_simulations = self.max_simulations if max_simulations is None else max_simulations
+        root = self.search_tree.find(history)
+        if root == NO_NODE:
+            self.search_tree.reset(history)
+            root = self.search_tree.root
+        # The current belief is the belief of the agent history only
+        use_cache = self.plan_cache is not None and hash_history(history) == self.history.hash
+        cached = None
+        if use_cache:
+            cached = self.plan_cache.lookup(self.current_belief)
+            if cached is not None:
+                if self.plan_cache.is_decided(cached[0]):
+                    self.nb_simulations = 0
+                    return best_tried_action(*cached)
+                if not (self.nb_workers > 1 and self.parallel == "root"):
+                    self.warm_start(root, *cached)
+        root_particles = self.search_tree.tree.get_particles(root)
+        if len(root_particles) == 0:
+            root_particles = particles_from_belief(self.current_belief, self.nb_particles, self.rng)
+        if self.nb_workers > 1:
+            return self._parallel_search(root, root_particles, time_out, max_simulations, use_cache, cached)
+        budget = np.inf if max_simulations is None else max_simulations
         start_time = time.time()
-        while time.time() - start_time < self.time_out:
-            state = self.sample_state_from_belief()
-            print(f"initial state (based on the belief of the agent): {state}")
-            self.simulate(state, history, depth=self.max_depth)
+        self.nb_simulations = 0
+        while self.nb_simulations < budget and not self.stop_event.is_set():
+            elapsed = time.time() - start_time
+            if elapsed >= time_out:
+                break
+            if self.early_stopping and self.nb_simulations > 0 \
+                    and self.nb_simulations % EARLY_STOPPING_PERIOD == 0:
+                remaining = min(budget - self.nb_simulations,
+                                self.nb_simulations/max(elapsed, 1e-9)*(time_out - elapsed))
+                if self.is_decided(root, remaining):
+                    break
+            if self.search_kernel is not None:
+                self.nb_simulations += self.search_kernel.run(
+                    self.search_tree.tree, root, root_particles,
+                    int(min(KERNEL_BATCH, budget - self.nb_simulations)),
+                )
+                continue
+            state = root_particles.sample(self.uniforms)
+            self.simulate(state, root, depth=0)
+            self.nb_simulations += 1
+        if self.instrumentation is not None:
+            self.instrumentation.end_search(self.nb_simulations, time.time() - start_time,
+                                            self.search_tree.tree)
+        if use_cache:
+            self.store_plan(root)
         # Values over the actions
-        children_values = [
-            child.value
-            for child in self.search_tree.get_root.get_children
-        ]
-        return np.argmax(children_values)
+        return self.search_tree.tree.best_action(root)
 
-    def simulate(self, state: int, history: List, depth: int):
-        current_node = self.search_tree.get_current_node
+    def warm_start(self, root: int, visits: np.ndarray, values: np.ndarray) -> None:
+        """
+        Seeds the statistics of a fresh root with cached ones
+        * With action widening, only the visited actions are added
+        """
+        tree = self.search_tree.tree
+        if not tree.is_leaf(root):
+            return
+        if self.action_widening is None:
+            if not tree.expand(root):
+                return
+        else:
+            for action in np.flatnonzero(visits):
+                if tree.add_action_child(root, int(action)) == NO_NODE:
+                    return
+        children = tree.action_children[root]
+        tried = children != NO_NODE
+        tree.nb_visits[children[tried]] = visits[tried]
+        tree.value[children[tried]] = values[tried]
+        tree.nb_visits[root] += visits.sum()
+
+    def store_plan(self, root: int) -> None:
+        tree = self.search_tree.tree
+        if not tree.is_leaf(root):
+            self.plan_cache.store(self.current_belief, *tree.action_statistics(root))
+
+    def is_decided(self, root: int, remaining_simulations: float) -> bool:
+        """
+        True when the most visited root action is also the best valued one
+        and its visit lead exceeds the remaining simulations
+        """
+        tree = self.search_tree.tree
+        if tree.is_leaf(root):
+            return False
+        visits, _ = tree.action_statistics(root)
+        most_visited = int(np.argmax(visits))
+        if most_visited != tree.best_action(root):
+            return False
+        lead = visits[most_visited] - np.partition(visits, -2)[-2]
+        return lead > remaining_simulations
 
-        if depth < self.max_depth:
-            return 0
+    def current_best_action(self) -> str:
+        """
+        Best action so far at the root of the real history, None before
+        the first expansion. Safe to poll while a search is running.
+        """
+        root = self.search_tree.find(self.history)
+        if root == NO_NODE or self.search_tree.tree.is_leaf(root):
+            return None
+        return self.env.action_int2str(self.search_tree.tree.best_action(root))
 
-        if history == [] or not self.search_tree.is_in_tree(history):
-            for action in self.possible_actions.keys():
-                current_node.add_child(Node(parent=current_node, action=action,
-                                            history=deepcopy(history).append(action)))
-            return self.rollout(state, history, depth)
-
-        values = [
-            child.value + self.ucb_cst*np.sqrt(np.log(current_node.get_nb_visits)/child.get_nb_visits)
-            for child in current_node.get_children
-        ]
-        best_index = np.argmax(values)
-        best_child = current_node.children[best_index]
-        best_action = best_child.history[-1]
-        next_state, next_obs, reward = self.env.step_po(state, best_action)
-        # Update the belief
-        self.update_belief(best_action, next_obs)
-
-        new_history = deepcopy(history)
-        new_history.append(best_action)
-        new_history.append(next_obs)
-        ret = reward + self.discout_factor*self.simulate(next_state,
-                                                         new_history,
-                                                         depth+1)
-        current_node.nb_visits += 1
-        best_child.nb_visits += 1
-        best_child.value += (ret-best_child.value)/best_child.nb_visits
+    def _parallel_search(
+        self,
+        root: int,
+        root_particles: ParticleBelief,
+        time_out: float,
+        max_simulations: int,
+        use_cache: bool=False,
+        cached: Tuple[np.ndarray, np.ndarray]=None,
+    ) -> int:
+        """
+        Root parallelization leaves the agent tree untouched,
+        so nothing is reused at the next step.
+        * use_cache: store the root statistics in the plan cache, merged
+        with the cached ones for root parallelization
+        """
+        if self.parallel_search is None:
+            if self.parallel == "root":
+                self.parallel_search = RootParallelSearch(self, self.nb_workers, spawn_seeds(self.rng, 1)[0])
+            elif self.parallel == "tree":
+                self.parallel_search = TreeParallelSearch(self, self.nb_workers)
+            else:
+                raise ValueError(f"Unknown parallel search: {self.parallel}")
+        if self.parallel == "root":
+            action, visits, values = self.parallel_search.search(root_particles.get_particles, time_out, max_simulations)
+            if use_cache:
+                if cached is not None:
+                    visits, values = merge_root_statistics(np.stack([cached[0], visits]), np.stack([cached[1], values]))
+                    action = best_tried_action(visits, values)
+                self.plan_cache.store(self.current_belief, visits, values)
+        else:
+            action = self.parallel_search.search(root, root_particles, time_out, max_simulations)
+            if use_cache:
+                self.store_plan(root)
+        self.nb_simulations = self.parallel_search.nb_simulations
+        return action
 
-        return ret
+    def close(self) -> None:
+        if isinstance(self.parallel_search, RootParallelSearch):
+            self.parallel_search.close()
+        self.parallel_search = None
 
-    def rollout_policy(self, history: List):
+    def expand(self, node: int) -> None:
         """
-        Returns an action randomly (random policy)
+        Adds the action children of a leaf, or the first one with
+        action widening
         """
-        return self.env.action_int2str(np.random.choice(len(self.possible_actions)))
+        if self.action_widening is None:
+            self.search_tree.tree.expand(node)
+        else:
+            self.widen_actions(node)
 
-    def rollout(self, state: int, history: List, depth: int):
-        if depth < self.max_depth:
+    def widen_actions(self, node: int) -> None:
+        """
+        Adds a random untried action while the node has at most
+        k*N^alpha action children
+        """
+        tree = self.search_tree.tree
+        nb_children = tree.nb_children[node]
+        k, alpha = self.action_widening
+        if nb_children < tree.n_actions and nb_children <= k*tree.nb_visits[node]**alpha:
+            untried = np.flatnonzero(tree.action_children[node] == NO_NODE)
+            tree.add_action_child(node, int(untried[self.uniforms.integers(len(untried))]))
+
+    def route_observation(self, action_node: int) -> int:
+        """
+        Existing observation child the simulation goes on in, NO_NODE
+        when observation widening allows a new branch
+        """
+        tree = self.search_tree.tree
+        nb_children = tree.nb_children[action_node]
+        k, alpha = self.observation_widening
+        if nb_children == 0 or nb_children <= k*tree.nb_visits[action_node]**alpha:
+            return NO_NODE
+        return tree.sample_observation_child(action_node, self.uniforms.random())
+
+    def simulate(self, state: int, node: int, depth: int, record_particle: bool=True):
+        """
+        * node: observation node of the simulated history,
+        reached from the root through (action, observation) edges
+        * record_particle: False when the simulation was routed to node
+        or one of its ancestors by observation widening, state may not
+        match the observations of its history
+        """
+        instrumentation = self.instrumentation
+        if depth >= self.max_depth:
+            if instrumentation is not None:
+                instrumentation.record_depth(depth)
             return 0
-        action = self.rollout_policy(history)
-        next_state, _, reward, _ = self.env.step_po(state, action)
-        return reward + self.discout_factor*self.rollout(next_state, history, depth+1)
+
+        tree = self.search_tree.tree
+        if record_particle:
+            tree.get_particles(node).add(state)
+
+        if tree.is_leaf(node):
+            if instrumentation is None:
+                self.expand(node)
+                return self.rollout(state, node, depth)
+            instrumentation.record_depth(depth)
+            start_time = instrumentation.start()
+            self.expand(node)
+            instrumentation.record("expansion", start_time)
+            start_time = instrumentation.start()
+            ret = self.rollout(state, node, depth)
+            instrumentation.record("rollout", start_time)
+            return ret
+
+        if instrumentation is not None:
+            start_time = instrumentation.start()
+        if self.action_widening is not None:
+            self.widen_actions(node)
+        best_child = tree.ucb_select(node, self.ucb_cst)
+        best_action = int(tree.action[best_child])
+        if instrumentation is not None:
+            instrumentation.record("selection", start_time)
+            start_time = instrumentation.start()
+        next_state, next_obs, reward = self.generator(state, best_action)
+        if instrumentation is not None:
+            instrumentation.record("sampling", start_time)
+
+        next_node = tree.observation_child(best_child, next_obs)
+        routed = False
+        if next_node == NO_NODE and self.observation_widening is not None:
+            next_node = self.route_observation(best_child)
+            routed = next_node != NO_NODE
+        if next_node == NO_NODE:
+            if instrumentation is not None:
+                start_time = instrumentation.start()
+            next_node = tree.add_observation_child(best_child, next_obs)
+            if instrumentation is not None:
+                instrumentation.record("expansion", start_time)
+        if next_node == NO_NODE:
+            # The tree is full: evaluate without growing it
+            if instrumentation is not None:
+                instrumentation.record_depth(depth+1)
+                start_time = instrumentation.start()
+            future = self.rollout(next_state, node, depth+1)
+            if instrumentation is not None:
+                instrumentation.record("rollout", start_time)
+        else:
+            future = self.simulate(next_state, next_node, depth+1, record_particle and not routed)
+        ret = reward + self.discout_factor*future
+        if instrumentation is not None:
+            start_time = instrumentation.start()
+        tree.backup(node, best_child, ret)
+        if instrumentation is not None:
+            instrumentation.record("backup", start_time)
+
+        return ret
+
+    def rollout(self, state: int, node: int, depth: int):
+        """
+        Leaf evaluation by the rollout engine
+        * node: observation node the rollout started from
+        """
+        return self.rollout_engine.evaluate(state, depth)
 
     def _plan_action(self) -> str:
-        print("Searching...")
+        if self.verbose:
+            print("Searching...")
         action = self.search(self.history)
         action = self.env.action_int2str(action)
         return action
 
     def take_action(self) -> str:
         if self.env.is_in_goal:
-            print(f"I am in goal state. I got {self.total_reward} as total reward.")
-            print(f"I will not execute any other action.")
+            if self.verbose:
+                print(f"I am in goal state. I got {self.total_reward} as total reward.")
+                print(f"I will not execute any other action.")
             return
         action = self._plan_action()
-        print(f"Action planned: {action}")
+        if self.verbose:
+            print(f"Action planned: {action}")
         reward, new_obs, done = self.env.step(action)
+        self.observe(action, new_obs, reward, done)
+        return action
+
+    def observe(self, action: str, observation: Tuple, reward: float=0., done: bool=False) -> None:
+        """
+        Records a real step: updates the belief, the particles and
+        the search tree, which is pruned to the new history
+        """
+        # Invalid steps raise before any state of the agent changes
+        self.check_model()
+        action_index = self.env.action_str2int(action)
+        observation_index = self.env.observation2int(observation)
+        previous_particles = self.search_tree.tree.get_particles(self.search_tree.find(self.history))
+        if self.instrumentation is not None:
+            start_time = self.instrumentation.start()
+        # Raises on an observation impossible under the belief
+        self.update_belief(action, observation)
         self.total_reward = reward + self.discout_factor*self.total_reward
+        self.last_reward = reward
+        self.done = done
+        action, observation = action_index, observation_index
         self.history.append(action)
-        self.history.append(new_obs)
+        self.history.append(observation)
+        self.update_particles(previous_particles, action, observation)
+        if self.instrumentation is not None:
+            self.instrumentation.record("belief_update", start_time)
         # Prune the search tree
-        action_node = None
-        for child in self.search_tree.get_current_node.get_children:
-            if child.action == action:
-                action_node = child
-        self.search_tree.prune(action_node)
-        return action
+        self.reused_simulations = self.search_tree.prune(self.search_tree.find(self.history))
+        if self.verbose:
+            print(f"Reused {self.reused_simulations} simulations for the next decision")
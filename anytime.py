@@ -0,0 +1,52 @@
+import threading
+
+from agent import POMCPAgent
+
+class AnytimePlanner(object):
+    """
+    Runs the agent search in a background thread so the caller can
+    poll the current best action and stop the search at its deadline.
+    """
+    def __init__(self, agent: POMCPAgent) -> None:
+        self.agent = agent
+        self.thread = None
+        self.action = None
+
+    def start(self, time_out: float=None, max_simulations: int=None) -> None:
+        if self.is_running:
+            raise RuntimeError("A search is already running.")
+        self.action = None
+        self.agent.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, args=(time_out, max_simulations), daemon=True)
+        self.thread.start()
+
+    def _run(self, time_out: float, max_simulations: int) -> None:
+        action = self.agent.search(self.agent.history, time_out, max_simulations)
+        self.action = self.agent.env.action_int2str(action)
+
+    @property
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def best_action(self) -> str:
+        """
+        Current best action, final once the search is over
+        """
+        if self.action is not None:
+            return self.action
+        return self.agent.current_best_action()
+
+    def stop(self) -> str:
+        """
+        Stops the search and returns its best action
+        """
+        self.agent.stop_event.set()
+        action = self.wait()
+        # Later searches of the agent run normally
+        self.agent.stop_event.clear()
+        return action
+
+    def wait(self, timeout: float=None) -> str:
+        if self.thread is not None:
+            self.thread.join(timeout)
+        return self.best_action()
@@ -0,0 +1,154 @@
+import numpy as np
+from typing import Union
+
+from pomdp import TransitionModel, SparseTransitionModel, ObservationModel
+from rng import UniformBlock, make_rng
+
+"""
+Belief engine: exact Bayes filter over the POMDP tensors.
+    * b'(s') = O(a, s', z) * sum_s T(s, a, s') * b(s) / eta
+    * eta = sum_s' O(a, s', z) * sum_s T(s, a, s') * b(s)
+* Dense and sparse transition models propagate the belief themselves.
+"""
+
+class BeliefUpdater(object):
+    def __init__(
+        self,
+        transition_model: Union[TransitionModel, SparseTransitionModel],
+        observation_model: ObservationModel,
+    ) -> None:
+        self.transition_model = transition_model
+        self.observation_model = observation_model
+
+    def predict(self, belief: np.ndarray, action: int) -> np.ndarray:
+        """
+        sum_s T(s, a, .) * b(s), restricted to the support of the belief
+        """
+        return self.transition_model.propagate(belief, action)
+
+    def update(self, belief: np.ndarray, action: int, observation: int) -> np.ndarray:
+        """
+        One masked matrix-vector product per step.
+        Raises ValueError if the observation is impossible under the belief.
+        """
+        posterior = self.predict(belief, action)
+        posterior *= self.observation_model.observation_probs[action, :, observation]
+        normalizer = posterior.sum()
+        if normalizer <= 0:
+            raise ValueError("Observation has zero probability under the current belief.")
+        return posterior/normalizer
+
+    def update_batch(
+        self,
+        beliefs: np.ndarray,
+        actions: np.ndarray,
+        observations: np.ndarray,
+    ) -> np.ndarray:
+        """
+        * beliefs: (n_beliefs, n_states)
+        * actions, observations: (n_beliefs,)
+        Returns the (n_beliefs, n_states) posteriors.
+        """
+        beliefs = np.atleast_2d(beliefs)
+        actions = np.broadcast_to(actions, beliefs.shape[:1])
+        observations = np.broadcast_to(observations, beliefs.shape[:1])
+        posteriors = self.transition_model.propagate_batch(beliefs, actions)
+        posteriors *= self.observation_model.observation_probs[actions, :, observations]
+        normalizers = posteriors.sum(axis=1, keepdims=True)
+        if np.any(normalizers <= 0):
+            raise ValueError("Observation has zero probability under one of the beliefs.")
+        return posteriors/normalizers
+
+def uniform_belief(n_states: int) -> np.ndarray:
+    return np.full(n_states, 1/n_states)
+
+class ParticleBelief(object):
+    """
+    Unweighted particle set stored on an observation node (Silver & Veness).
+    * Particles are state indices kept in a growable int array.
+    * With max_size, the set is a reservoir sample of all the states
+    added: its memory no longer grows with the number of simulations.
+    """
+    def __init__(self, capacity: int=64, max_size: int=None, uniforms: UniformBlock=None) -> None:
+        """
+        * uniforms: replacement draws once max_size is reached
+        """
+        if max_size is not None:
+            capacity = min(capacity, max_size)
+        self.particles = np.empty(max(capacity, 1), dtype=np.int64)
+        self.size = 0
+        self.max_size = max_size
+        self.uniforms = uniforms
+        # States added, kept or not
+        self.nb_added = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __str__(self) -> str:
+        return f"ParticleBelief({self.size})"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def add(self, state: int) -> None:
+        self.nb_added += 1
+        if self.max_size is not None and self.size == self.max_size:
+            # Reservoir sampling: the new state replaces a random one
+            # with probability max_size/nb_added
+            slot = self.uniforms.integers(self.nb_added)
+            if slot < self.max_size:
+                self.particles[slot] = state
+            return
+        if self.size == len(self.particles):
+            self.particles = np.resize(self.particles, self._grown_length(self.size + 1))
+        self.particles[self.size] = state
+        self.size += 1
+
+    def extend(self, states: np.ndarray) -> None:
+        states = np.asarray(states, dtype=np.int64)
+        room = len(states)
+        if self.max_size is not None:
+            room = min(room, self.max_size - self.size)
+        needed = self.size + room
+        if needed > len(self.particles):
+            self.particles = np.resize(self.particles, self._grown_length(needed))
+        self.particles[self.size:needed] = states[:room]
+        self.size = needed
+        self.nb_added += room
+        if room < len(states):
+            overflow = states[room:]
+            nb_added = self.nb_added + 1 + np.arange(len(overflow))
+            slots = (self.uniforms.take(len(overflow))*nb_added).astype(np.int64)
+            kept = slots < self.max_size
+            # In order, a later state overwrites an earlier one in the same slot
+            self.particles[slots[kept]] = overflow[kept]
+            self.nb_added += len(overflow)
+
+    def _grown_length(self, needed: int) -> int:
+        length = max(needed, 2*len(self.particles))
+        return length if self.max_size is None else min(length, self.max_size)
+
+    def sample(self, rng: Union[np.random.Generator, UniformBlock]=None) -> int:
+        """
+        * rng: a UniformBlock in hot loops
+        """
+        rng = make_rng(rng) if rng is None else rng
+        return int(self.particles[rng.integers(self.size)])
+
+    def clear(self) -> None:
+        self.size = 0
+        self.nb_added = 0
+
+    @property
+    def get_particles(self) -> np.ndarray:
+        return self.particles[:self.size]
+
+    def to_belief(self, n_states: int) -> np.ndarray:
+        counts = np.bincount(self.get_particles, minlength=n_states)
+        return counts/max(self.size, 1)
+
+def particles_from_belief(belief: np.ndarray, n_particles: int, rng: np.random.Generator=None) -> ParticleBelief:
+    particles = ParticleBelief(n_particles)
+    particles.extend(make_rng(rng).choice(len(belief), size=n_particles, p=belief))
+    return particles
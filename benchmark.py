@@ -0,0 +1,167 @@
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+from typing import Callable, Dict, List
+
+import config
+from grid import Grid
+from agent import POMCPAgent
+from grid_model import compile_grid_model
+from belief import particles_from_belief
+from generator import Generator
+from parallel import RootParallelSearch
+
+"""
+Headless planner benchmarks.
+* planner: sweeps grid sizes (MULT_FACTOR), depths and time budgets
+* parallel: root-parallel scaling with the number of workers
+Results are written as JSON to compare versions.
+"""
+
+def make_agent(mult_factor: int=config.MULT_FACTOR, **agent_params) -> POMCPAgent:
+    env = Grid(mult_factor, mult_factor, render=False)
+    env.reset()
+    env.set_pomdp_model(compile_grid_model(env, sparse=True))
+    return POMCPAgent(env, **agent_params)
+
+def calls_per_second(function: Callable, min_time: float=0.2) -> float:
+    nb_calls = 0
+    start_time = time.perf_counter()
+    while True:
+        function()
+        nb_calls += 1
+        elapsed = time.perf_counter() - start_time
+        if elapsed >= min_time:
+            return nb_calls/elapsed
+
+def hot_paths(agent: POMCPAgent) -> Dict[str, float]:
+    """
+    Calls per second of the search building blocks
+    """
+    tree = agent.search_tree.tree
+    root = tree.root
+    state = agent.sample_state_from_belief()
+    observation = agent.env.get_current_observation
+    generator = Generator(agent.pomdp_model)
+    return {
+        "simulate": calls_per_second(lambda: agent.simulate(state, root, depth=0)),
+        "rollout": calls_per_second(lambda: agent.rollout(state, root, depth=0)),
+        "update_belief": calls_per_second(lambda: agent.belief_updater.update(
+            agent.current_belief, 0, agent.env.observation2int(observation))),
+        "generator": calls_per_second(lambda: generator(state, 0)),
+    }
+
+def benchmark_planner(
+    mult_factor: int,
+    max_depth: int,
+    time_out: float,
+    nb_decisions: int,
+) -> Dict:
+    agent = make_agent(mult_factor, max_depth=max_depth, time_out=time_out)
+    latencies = []
+    simulations = []
+    for _ in range(nb_decisions):
+        agent.search_tree.reset(agent.history)
+        start_time = time.perf_counter()
+        agent.search(agent.history)
+        latencies.append(time.perf_counter() - start_time)
+        simulations.append(agent.nb_simulations)
+    tree_size = len(agent.search_tree.tree)
+
+    # Memory is traced on a separate decision, tracing slows the search down
+    agent.search_tree.reset(agent.history)
+    tracemalloc.start()
+    agent.search(agent.history)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = np.array(latencies)
+    return {
+        "mult_factor": mult_factor,
+        "nb_states": agent.env.get_number_states,
+        "max_depth": max_depth,
+        "time_out": time_out,
+        "simulations_per_second": float(np.sum(simulations)/np.sum(latencies)),
+        "tree_size": tree_size,
+        "peak_memory_bytes": peak_memory,
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p90": float(np.percentile(latencies, 90)),
+        "latency_p99": float(np.percentile(latencies, 99)),
+        "hot_paths_per_second": hot_paths(agent),
+    }
+
+def planner_sweep(
+    mult_factors: List[int],
+    depths: List[int],
+    time_outs: List[float],
+    nb_decisions: int=5,
+) -> List[Dict]:
+    return [
+        benchmark_planner(mult_factor, max_depth, time_out, nb_decisions)
+        for mult_factor in mult_factors
+        for max_depth in depths
+        for time_out in time_outs
+    ]
+
+def parallel_scaling(worker_counts: List[int], time_out: float=5., seed: int=0) -> List[Dict]:
+    """
+    Simulations per second of root-parallel search for each worker count
+    """
+    agent = make_agent()
+    root_particles = particles_from_belief(agent.current_belief, agent.nb_particles, agent.rng).get_particles
+    results = []
+    for nb_workers in worker_counts:
+        with RootParallelSearch(agent, nb_workers, seed) as search:
+            # Warm up: start the worker processes
+            search.search(root_particles, time_out=0.1)
+            start_time = time.time()
+            search.search(root_particles, time_out=time_out)
+            elapsed = time.time() - start_time
+        results.append({
+            "nb_workers": nb_workers,
+            "simulations": search.nb_simulations,
+            "simulations_per_second": search.nb_simulations/elapsed,
+        })
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="POMCP planner benchmarks")
+    parser.add_argument("suite", choices=["planner", "parallel"], nargs="?", default="planner")
+    parser.add_argument("--mult-factors", type=int, nargs="+", default=[3, 5, 10])
+    parser.add_argument("--depths", type=int, nargs="+", default=[5, 10])
+    parser.add_argument("--time-outs", type=float, nargs="+", default=[0.5])
+    parser.add_argument("--decisions", type=int, default=5)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--time-out", type=float, default=5.)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON results file")
+    args = parser.parse_args()
+
+    if args.suite == "planner":
+        results = planner_sweep(args.mult_factors, args.depths, args.time_outs, args.decisions)
+        for result in results:
+            print(f"{result['nb_states']:>6} states, depth {result['max_depth']:>3}, "
+                  f"{result['time_out']}s: {result['simulations_per_second']:>9.0f} simulations/s, "
+                  f"tree {result['tree_size']} nodes, peak {result['peak_memory_bytes']/2**20:.1f} MiB, "
+                  f"p50/p99 {result['latency_p50']:.3f}/{result['latency_p99']:.3f}s")
+    else:
+        results = parallel_scaling(args.workers, args.time_out, args.seed)
+        for result in results:
+            print(f"{result['nb_workers']:>3} workers: "
+                  f"{result['simulations_per_second']:>10.0f} simulations/s "
+                  f"({result['simulations']} simulations)")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({
+                "suite": args.suite,
+                "timestamp": time.time(),
+                "python": sys.version,
+                "platform": platform.platform(),
+                "numpy": np.__version__,
+                "results": results,
+            }, f, indent=2)
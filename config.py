@@ -1,10 +1,14 @@
 ## Grid parameters:
-TILE_SIZE = 150
 MULT_FACTOR = 3
-WIDTH = TILE_SIZE*MULT_FACTOR
-HEIGHT = TILE_SIZE*MULT_FACTOR
+# Grid size in cells
+N_COLS = MULT_FACTOR
+N_ROWS = MULT_FACTOR
+# Pixels per cell, rendering only
+TILE_SIZE = 150
+WIDTH = TILE_SIZE*N_COLS
+HEIGHT = TILE_SIZE*N_ROWS
 
-NB_STATES = (HEIGHT//TILE_SIZE)*(WIDTH//TILE_SIZE)
+NB_STATES = N_COLS*N_ROWS
 
 GOAL_CELL_COLOR = (0, 255, 0) # Index 3
 
@@ -14,6 +18,9 @@ POSSIBLE_COLORS = [
     (200, 50, 120) # Index 2
 ]
 
+# Observation index of each color, as used by the ObservationModel
+OBSERVATIONS = POSSIBLE_COLORS + [GOAL_CELL_COLOR]
+
 BLACK_COLOR = (0, 0, 0)
 
 AGENT_COLOR = (255, 255, 0) # YELLOW
@@ -23,3 +30,13 @@ ACTIONS = {
     "right": 2,
     "bottom": 3
 }
+# (dx, dy) of each action
+MOVEMENTS = {
+    "left": (-1, 0),
+    "top": (0, -1),
+    "right": (1, 0),
+    "bottom": (0, 1)
+}
+
+GOAL_REWARD = 10
+STEP_REWARD = -1
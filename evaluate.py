@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+from typing import Dict, List, Set
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import config
+from grid import Grid
+from agent import POMCPAgent
+from grid_model import compile_grid_model
+from rng import spawn_seeds
+
+"""
+Batch evaluation over many random grids.
+* Every episode gets its own seed, spawned from the run seed by
+episode index, and its own Grid, compiled POMDPModel and POMCPAgent.
+* Episodes run across a process pool and their results are appended
+to a JSON lines file as they finish.
+* The first record of the file is the run configuration. Episodes
+already in the file are skipped, so an interrupted run resumes, and a
+file of another configuration is refused.
+"""
+
+def episode_seed(seed: int, episode: int) -> int:
+    return int(np.random.SeedSequence(seed, spawn_key=(episode,)).generate_state(1)[0])
+
+def run_episode(
+    episode: int,
+    seed: int,
+    mult_factor: int=config.MULT_FACTOR,
+    max_steps: int=50,
+    agent_params: Dict=None,
+    slip: float=0.,
+) -> Dict:
+    # Independent streams for the world and the agent
+    world_seed, agent_seed = spawn_seeds(seed, 2)
+    env = Grid(mult_factor, mult_factor, render=False, rng=world_seed, slip=slip)
+    env.reset()
+    env.set_pomdp_model(compile_grid_model(env, slip, sparse=True))
+    agent = POMCPAgent(env, seed=agent_seed, verbose=False, **(agent_params or {}))
+
+    total_return = 0.
+    planning_time = 0.
+    steps = 0
+    while steps < max_steps and not env.is_in_goal:
+        start_time = time.perf_counter()
+        agent.take_action()
+        planning_time += time.perf_counter() - start_time
+        total_return += agent.last_reward
+        steps += 1
+    agent.close()
+    return {
+        "episode": episode,
+        "seed": seed,
+        "goal_state": int(env.goal_state),
+        "return": float(total_return),
+        "discounted_return": float(agent.total_reward),
+        "steps": steps,
+        "reached_goal": bool(env.is_in_goal),
+        "planning_time": planning_time,
+    }
+
+def run_config(
+    seed: int,
+    mult_factor: int=config.MULT_FACTOR,
+    max_steps: int=50,
+    agent_params: Dict=None,
+    slip: float=0.,
+) -> Dict:
+    """
+    Parameters the episodes of a run depend on, as read back from JSON
+    """
+    return json.loads(json.dumps({
+        "seed": seed,
+        "mult_factor": mult_factor,
+        "max_steps": max_steps,
+        "agent_params": agent_params or {},
+        "slip": slip,
+    }))
+
+def read_records(output_path: str) -> List[Dict]:
+    """
+    Records of the file, ignoring a line cut by an interruption
+    """
+    records = []
+    if not os.path.exists(output_path):
+        return records
+    with open(output_path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+def load_finished(output_path: str, configuration: Dict) -> Set[int]:
+    """
+    Episodes already written for configuration (see run_config).
+    Raises ValueError when the file holds another run.
+    """
+    records = read_records(output_path)
+    if not records:
+        return set()
+    if records[0].get("config") != configuration:
+        raise ValueError(f"{output_path} holds another run ({records[0].get('config')}), "
+                         f"cannot resume it with {configuration}.")
+    finished = set()
+    for record in records[1:]:
+        if "episode" not in record:
+            continue
+        if record.get("seed") != episode_seed(configuration["seed"], record["episode"]):
+            raise ValueError(f"Episode {record['episode']} of {output_path} was run with another seed.")
+        finished.add(record["episode"])
+    return finished
+
+def evaluate(
+    nb_episodes: int,
+    output_path: str,
+    nb_workers: int=None,
+    seed: int=0,
+    mult_factor: int=config.MULT_FACTOR,
+    max_steps: int=50,
+    agent_params: Dict=None,
+    slip: float=0.,
+) -> List[Dict]:
+    """
+    Returns the results of the episodes run by this call
+    """
+    configuration = run_config(seed, mult_factor, max_steps, agent_params, slip)
+    finished = load_finished(output_path, configuration)
+    todo = [episode for episode in range(nb_episodes) if episode not in finished]
+    results = []
+    # A file without a complete record is started over
+    mode = "a+" if read_records(output_path) else "w"
+    with ProcessPoolExecutor(nb_workers) as pool, open(output_path, mode) as f:
+        if mode == "w":
+            f.write(json.dumps({"config": configuration}) + "\n")
+            f.flush()
+        # Terminate a line cut by an interruption
+        elif f.tell() > 0:
+            f.seek(f.tell() - 1)
+            if f.read(1) != "\n":
+                f.write("\n")
+        futures = [
+            pool.submit(run_episode, episode, episode_seed(seed, episode),
+                        mult_factor, max_steps, agent_params, slip)
+            for episode in todo
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            f.write(json.dumps(result) + "\n")
+            f.flush()
+            results.append(result)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch evaluation of the POMCP agent")
+    parser.add_argument("--episodes", type=int, default=100)
+    parser.add_argument("--output", default="evaluation.jsonl")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mult-factor", type=int, default=config.MULT_FACTOR)
+    parser.add_argument("--max-steps", type=int, default=50)
+    parser.add_argument("--time-out", type=float, default=1.)
+    parser.add_argument("--max-simulations", type=int, default=None)
+    parser.add_argument("--slip", type=float, default=0.)
+    args = parser.parse_args()
+
+    agent_params = {"time_out": args.time_out, "max_simulations": args.max_simulations}
+    results = evaluate(args.episodes, args.output, args.workers, args.seed,
+                       args.mult_factor, args.max_steps, agent_params, args.slip)
+    if results:
+        print(f"{len(results)} episodes: mean return {np.mean([r['return'] for r in results]):.2f}, "
+              f"goal reached {np.mean([r['reached_goal'] for r in results]):.0%}")
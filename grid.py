@@ -1,23 +1,23 @@
-import pygame
-import random
 import numpy as np
 from typing import List, Tuple, Dict
 from pomdp import POMDPModel
+from simulator import Simulator
+from rng import make_rng
 
 import config
 
 class Cell(object):
-    def __init__(self, x: int, y: int, tile_size: int, state: int, is_goal: bool):
+    """
+    View of one cell, built on demand from the arrays of the Grid
+    """
+    def __init__(self, x: int, y: int, tile_size: int, state: int, is_goal: bool, color: Tuple):
         self.state = state
         self.is_goal = is_goal
         self.x = x
         self.y = y
         self.tile_size = tile_size
         # Color is our only observation
-        if self.is_goal:
-            self.color = config.GOAL_CELL_COLOR
-        else:
-            self.color = random.choice(config.POSSIBLE_COLORS)
+        self.color = color
 
     @property
     def is_goal_cell(self) -> bool:
@@ -31,88 +31,129 @@ class Cell(object):
     def get_color(self) -> Tuple:
         return self.color
 
-    def draw_cell(self, screen: pygame.Surface):
-        pos_x, pos_y = self.x*self.tile_size, self.y*self.tile_size
-        pygame.draw.rect(
-            screen,
-            self.color,
-            (pos_x, pos_y, self.tile_size, self.tile_size),
-        )
-        wall_thickness = 2
-        lines = [
-            ((pos_x, pos_y), (pos_x+self.tile_size, pos_y)),
-            ((pos_x+self.tile_size, pos_y), (pos_x+self.tile_size, pos_y+self.tile_size)),
-            ((pos_x+self.tile_size, pos_y+self.tile_size), (pos_x, pos_y+self.tile_size)),
-            ((pos_x, pos_y+self.tile_size), (pos_x, pos_y))
-        ]
-        for line in lines:
-            pygame.draw.line(screen, config.BLACK_COLOR, line[0], line[1], wall_thickness)
-
-        font = pygame.font.Font('freesansbold.ttf', 32)
-        text_surface = font.render(str(self.state), True, config.BLACK_COLOR)
-        text_rect = text_surface.get_rect(center=(pos_x+self.tile_size//2, pos_y+self.tile_size//2))
-        screen.blit(text_surface, text_rect)
-
 class Grid(object):
     """
+    Grid of n_cols x n_rows cells, states are numbered row by row.
+    * The layout is the goal state and one uint8 colour (observation
+    index) per cell. Colours are drawn from a seed the first time they
+    are needed: creating a grid of 10^6 cells allocates nothing else.
+    * Pixel sizes (width, height) only matter to the renderer.
     """
     def __init__(
         self,
-        width: int,
-        height: int,
-        tile_size: int,
-        pomdp_model: POMDPModel,
+        n_cols: int,
+        n_rows: int,
+        pomdp_model: POMDPModel=None,
         render: bool=True,
         possible_actions: Dict=config.ACTIONS,
+        blocking: bool=True,
+        rng: np.random.Generator=None,
+        tile_size: int=config.TILE_SIZE,
+        slip: float=0.,
     ) -> None:
+        """
+        * pomdp_model: model of the simulated steps, None until set_pomdp_model
+        (e.g. grid_model.compile_grid_model of this layout)
+        * render=False runs headless: pygame is never imported
+        * blocking: wait for "q" after every rendered step
+        * rng: generator or seed of the layouts and of the simulated steps
+        * tile_size: pixels per cell in the renderer
+        * slip: probability that a real step moves along another action,
+        drawn uniformly, as in grid_model.compile_grid_model
+        """
+        self.rng = make_rng(rng)
+        self.n_cols = n_cols
+        self.n_rows = n_rows
+        self.tile_size = tile_size
+        self.slip = slip
         # POMDP definition for our grid
+        self.pomdp_model = self.transition_model = self.observation_model = self.simulator = None
+        if pomdp_model is not None:
+            self.set_pomdp_model(pomdp_model)
+
+        self.possible_actions = possible_actions
+        self._new_layout()
+        self._init_agent()
+
+        self.render = render
+        self.renderer = None
+        if self.render:
+            from renderer import GridRenderer
+            self.renderer = GridRenderer(self.width, self.height, tile_size, blocking)
+
+    def set_pomdp_model(self, pomdp_model: POMDPModel) -> None:
+        """
+        Swaps the model used for simulated steps, e.g. for the one
+        compiled from this layout by grid_model.compile_grid_model
+        """
         self.pomdp_model = pomdp_model
         self.transition_model = self.pomdp_model.get_transition_model
         self.observation_model = self.pomdp_model.get_observation_model
+        self.simulator = Simulator(self.pomdp_model, self.rng)
 
-        self.height = height
-        self.width = width
-        self._init_pygame()
+    @property
+    def width(self) -> int:
+        return self.n_cols*self.tile_size
 
-        self.tile_size = tile_size
+    @property
+    def height(self) -> int:
+        return self.n_rows*self.tile_size
 
-        self.goal_state = np.random.choice(self.get_number_states)
-        self.possible_actions = possible_actions
+    def _new_layout(self) -> None:
+        self.goal_state = int(self.rng.integers(self.get_number_states))
+        self.color_seed = int(self.rng.integers(2**63))
+        self._colors = None
 
-        self.cells = self.get_cells()
-        self._init_agent()
+    @property
+    def colors(self) -> np.ndarray:
+        """
+        Observation index of every cell, uint8
+        """
+        if self._colors is None:
+            colors = np.random.default_rng(self.color_seed).integers(
+                len(config.POSSIBLE_COLORS), size=self.get_number_states, dtype=np.uint8)
+            colors[self.goal_state] = config.OBSERVATIONS.index(config.GOAL_CELL_COLOR)
+            self._colors = colors
+        return self._colors
+
+    def get_cell(self, state: int) -> Cell:
+        y, x = self.number2coord(state)
+        return Cell(x, y, self.tile_size, state, state == self.goal_state,
+                    config.OBSERVATIONS[self.colors[state]])
 
-        self.render = render
+    @property
+    def cells(self) -> List[Cell]:
+        return self.get_cells()
 
     def get_cells(self) -> List[Cell]:
-        cells = []
-        for y in range(self.height//self.tile_size):
-            for x in range(self.width//self.tile_size):
-                if y*self.height//self.tile_size + x == self.goal_state:
-                    cell = Cell(x, y, self.tile_size, y*self.height//self.tile_size + x, True)
-                else:
-                    cell = Cell(x, y, self.tile_size, y*self.height//self.tile_size + x, False)
-                cells.append(cell)
-        return cells
+        """
+        One Cell per state: for rendering small grids only
+        """
+        return [self.get_cell(state) for state in range(self.get_number_states)]
 
     def coord2number(self, coord: Tuple):
-        return coord[0]*(self.height//self.tile_size) + coord[1]
+        """
+        * coord: (row, column), as returned by number2coord
+        """
+        return coord[0]*self.n_cols + coord[1]
 
     def number2coord(self, number: int):
-        cols = self.width//self.tile_size
+        cols = self.n_cols
         x = number//cols
         y = number%cols
         return x, y
 
+    @property
+    def agent_state(self) -> int:
+        return self.agent_y*self.n_cols + self.agent_x
+
     @property
     def is_in_goal(self):
-        current_cell = self._get_cell_in(self.agent_x, self.agent_y)
-        return current_cell.is_goal_cell
+        return self.agent_state == self.goal_state
 
     @property
     def get_current_observation(self):
-        current_cell = self._get_cell_in(self.agent_x, self.agent_y)
-        return current_cell.get_color
+        return config.OBSERVATIONS[self.colors[self.agent_state]]
 
     @property
     def get_possible_actions(self):
@@ -120,23 +161,17 @@ class Grid(object):
 
     @property    
     def get_number_states(self):
-        return (self.height//self.tile_size)*(self.width//self.tile_size)
-
-    def _init_pygame(self):
-        pygame.init()
-        # In the + 100 you have to display agent belief where he is vs really where he is 
-        self.screen = pygame.display.set_mode((self.width, self.height+100))
-        self.screen.fill((255, 255, 255))
-        pygame.display.set_caption(("POMDP GRID"))
+        return self.n_rows*self.n_cols
 
     def reset(self):
         """
-        Returns first observation
+        Draws a new layout and returns the first observation.
+        The model of the previous layout is dropped: set the one of the
+        new layout (grid_model.compile_grid_model) before planning.
         """
-        self.goal_state = np.random.choice(self.get_number_states)
-        self._init_pygame()
+        self._new_layout()
+        self.pomdp_model = self.transition_model = self.observation_model = self.simulator = None
         self._init_agent()
-        self.cells = self.get_cells()
         if self.render:
             self.draw_grid()
         return self.get_current_observation
@@ -150,17 +185,21 @@ class Grid(object):
             if self.possible_actions[str_action] == action:
                 return str_action
 
+    def observation2int(self, observation: Tuple) -> int:
+        return config.OBSERVATIONS.index(observation)
+
     def step_po(self, state: int, action: str):
         """
+        Simulated step from state, based on the pomdp dynamics.
+        Leaves the real agent untouched.
         Returns:
-        * Next state based on pomdp dynamics (not returned yet)
+        * Next state
         * Reward
-        * The new observation (Color of the current cell ?)
+        * The new observation (Color of the next cell)
         * Done: bool
         """
-        reward, obs, done = self.step(action)        
-        next_state = self.transition_model.sample_state(state, self.action_str2int(action))
-        return next_state, reward, obs, done        
+        next_state, obs, reward = self.simulator(state, self.action_str2int(action))
+        return next_state, reward, config.OBSERVATIONS[obs], next_state == self.goal_state
 
     def step(self, action: str):
         """
@@ -169,95 +208,62 @@ class Grid(object):
         * The new observation (Color of the current cell ?)
         * Done: bool
         """
-        movement = {
-            "left": (-1, 0),
-            "top": (0, -1),
-            "right": (1, 0),
-            "bottom": (0, 1)
-        }
-
-        dx, dy = movement[action]
-        new_x = (self.agent_x + dx)*self.tile_size
-        new_y = (self.agent_y + dy)*self.tile_size
-
-        if new_x < 0 or new_x >= self.width or new_y < 0 or new_y >= self.height:                
-            current_cell = self._get_cell_in(self.agent_x, self.agent_y)
+        if self.slip > 0 and self.rng.random() < self.slip:
+            others = [other for other in self.possible_actions if other != action]
+            action = others[self.rng.integers(len(others))]
+        dx, dy = config.MOVEMENTS[action]
+        new_x = self.agent_x + dx
+        new_y = self.agent_y + dy
+
+        if new_x < 0 or new_x >= self.n_cols or new_y < 0 or new_y >= self.n_rows:
             if self.render:
                 self.draw_grid()
-            return -1, current_cell.get_color, False
+            return config.STEP_REWARD, self.get_current_observation, False
 
         self.update_agent_position(new_x, new_y)
-        
-        current_cell = self._get_cell_in(self.agent_x, self.agent_y)
-        if current_cell.is_goal_cell:
+
+        if self.is_in_goal:
             if self.render:
                 self.draw_grid()
-            return 10, current_cell.get_color, True
+            return config.GOAL_REWARD, self.get_current_observation, True
 
         if self.render:
             self.draw_grid()
-        return -1, current_cell.get_color, False
+        return config.STEP_REWARD, self.get_current_observation, False
 
     def update_agent_position(self, new_x, new_y) -> None:
-        self.agent_x = new_x//self.tile_size
-        self.agent_y = new_y//self.tile_size
-
-    def _draw_cells(self) -> None:
-        for cell in self.cells:
-            cell.draw_cell(self.screen)
+        """
+        * new_x, new_y: column and row of the cell
+        """
+        self.agent_x = new_x
+        self.agent_y = new_y
 
     def _get_cell_in(self, x: int, y: int) -> Cell:
-        if x*self.tile_size < 0 or x*self.tile_size >= self.width or y*self.tile_size < 0 or y*self.tile_size >= self.height:
+        if x < 0 or x >= self.n_cols or y < 0 or y >= self.n_rows:
             raise ValueError("Index out of bounds.")
-        for cell in self.cells:
-            if cell.get_position == (x, y):
-                return cell
+        # Cells are stored row by row
+        return self.get_cell(y*self.n_cols + x)
 
     def _init_agent(self):
-        pick_cell = random.choice(self.cells)
-        while pick_cell.is_goal_cell:
-            pick_cell = random.choice(self.cells)        
-        self.agent_x, self.agent_y = pick_cell.get_position
+        # Uniform over the cells other than the goal, in one draw
+        pick = int(self.rng.integers(self.get_number_states - 1))
+        if pick >= self.goal_state:
+            pick += 1
+        self.agent_y, self.agent_x = self.number2coord(pick)
 
     @property
     def _get_agent_position(self):
         return self.agent_x, self.agent_y
 
-    def _draw_agent(self) -> None:
-        pos_x, pos_y = self.agent_x*self.tile_size, self.agent_y*self.tile_size
-        pygame.draw.circle(
-            self.screen,
-            config.AGENT_COLOR,
-            (pos_x + self.tile_size // 2, pos_y + self.tile_size // 2),
-            self.tile_size // 4
-        )
-
     def draw_grid(self) -> None:
-        clock = pygame.time.Clock()
-        self._draw_cells()
-        self._draw_agent()
-        running = True
-        while running:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    print("Exiting")
-                    running = False
-                # Quit if we click on "q"
-                elif event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_q:
-                        print("Exiting")
-                        running = False
-            pygame.display.flip()
-            clock.tick(30)
-
-        # pygame.quit()
-
-def make_env(pomdp_model: POMDPModel) -> Grid:
-    return Grid(config.WIDTH, config.HEIGHT,
-                config.TILE_SIZE, pomdp_model)
+        if self.renderer is not None:
+            self.renderer.draw(self)
+
+def make_env(pomdp_model: POMDPModel=None, render: bool=True, rng: np.random.Generator=None) -> Grid:
+    return Grid(config.N_COLS, config.N_ROWS, pomdp_model, render=render, rng=rng)
 
 if __name__ == '__main__':
-    grid_env = make_env()
+    grid_env = make_env(render=False)
     print(grid_env.coord2number((0, 1)))
     print(grid_env.number2coord(1))
     
\ No newline at end of file
@@ -0,0 +1,127 @@
+import os
+import hashlib
+import numpy as np
+
+import config
+from grid import Grid
+from pomdp import (
+    POMDPModel,
+    TransitionModel,
+    SparseTransitionModel,
+    ObservationModel,
+    RewardModel,
+)
+
+"""
+Compiles the real POMDP of a Grid layout:
+* T: the intended move with probability 1 - slip, any other move
+with probability slip/(n_actions - 1). Moves into a wall leave the
+agent in place, the goal is absorbing.
+* O: colour of the reached cell, a uniformly wrong colour with
+probability observation_noise.
+* R(s, a): expected reward of the move, GOAL_REWARD for entering
+the goal and STEP_REWARD otherwise, 0 once in the goal.
+Models can be cached on disk, keyed by the layout and the parameters.
+"""
+
+def _layout(grid: Grid):
+    """
+    Column, row and colour index of every state
+    """
+    ys, xs = np.divmod(np.arange(grid.get_number_states, dtype=np.int64), grid.n_cols)
+    return xs, ys, grid.colors.astype(np.int64)
+
+def _successor_tables(grid: Grid, xs: np.ndarray, ys: np.ndarray, slip: float):
+    """
+    Slot d of (s, a) holds the cell reached by moving along action d
+    """
+    n_states = len(xs)
+    n_cols, n_rows = grid.n_cols, grid.n_rows
+    state_at = np.full((n_cols, n_rows), -1, dtype=np.int64)
+    state_at[xs, ys] = np.arange(n_states)
+
+    actions = sorted(grid.possible_actions, key=grid.possible_actions.get)
+    n_actions = len(actions)
+    moved = np.empty((n_states, n_actions), dtype=np.int64)
+    for d, action in enumerate(actions):
+        dx, dy = config.MOVEMENTS[action]
+        new_xs, new_ys = xs + dx, ys + dy
+        inside = (new_xs >= 0) & (new_xs < n_cols) & (new_ys >= 0) & (new_ys < n_rows)
+        moved[:, d] = np.where(inside, state_at[np.clip(new_xs, 0, n_cols-1), np.clip(new_ys, 0, n_rows-1)],
+                               np.arange(n_states))
+    moved[grid.goal_state] = grid.goal_state
+
+    next_states = np.broadcast_to(moved[:, None, :], (n_states, n_actions, n_actions)).copy()
+    probs = np.full((n_actions, n_actions), slip/max(n_actions - 1, 1))
+    np.fill_diagonal(probs, 1 - slip)
+    probs = np.broadcast_to(probs, (n_states, n_actions, n_actions)).copy()
+    return next_states, probs
+
+def _compile(grid: Grid, slip: float, observation_noise: float):
+    xs, ys, colors = _layout(grid)
+    n_states, n_observations = len(xs), len(config.OBSERVATIONS)
+    next_states, probs = _successor_tables(grid, xs, ys, slip)
+    n_actions = next_states.shape[1]
+
+    emission = np.full((n_states, n_observations), observation_noise/max(n_observations - 1, 1))
+    emission[np.arange(n_states), colors] = 1 - observation_noise
+    observation_probs = np.broadcast_to(emission, (n_actions, n_states, n_observations)).copy()
+
+    terminal_states = np.zeros(n_states, dtype=bool)
+    terminal_states[grid.goal_state] = True
+    state_rewards = np.where(terminal_states, config.GOAL_REWARD, config.STEP_REWARD)
+    rewards = (probs*state_rewards[next_states]).sum(axis=2)
+    rewards[terminal_states] = 0.
+    return next_states, probs, observation_probs, rewards, terminal_states
+
+def layout_key(grid: Grid, slip: float, observation_noise: float) -> str:
+    _, _, colors = _layout(grid)
+    key = hashlib.sha1()
+    key.update(np.array([grid.n_cols, grid.n_rows, grid.goal_state], dtype=np.int64).tobytes())
+    key.update(colors.tobytes())
+    key.update(repr(sorted(grid.possible_actions.items())).encode())
+    key.update(np.array([slip, observation_noise]).tobytes())
+    return key.hexdigest()
+
+def compile_grid_model(
+    grid: Grid,
+    slip: float=0.,
+    observation_noise: float=0.,
+    sparse: bool=False,
+    cache_dir: str=None,
+) -> POMDPModel:
+    """
+    * slip: probability of moving along another action
+    * observation_noise: probability of observing a wrong colour
+    * sparse: SparseTransitionModel instead of the dense tensor
+    * cache_dir: directory of the on-disk cache (None for no cache)
+    """
+    tables = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, f"grid_model_{layout_key(grid, slip, observation_noise)}.npz")
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                tables = tuple(cached[name] for name in
+                               ("next_states", "probs", "observation_probs", "rewards", "terminal_states"))
+    if tables is None:
+        tables = _compile(grid, slip, observation_noise)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(cache_path, next_states=tables[0], probs=tables[1], observation_probs=tables[2],
+                     rewards=tables[3], terminal_states=tables[4])
+    next_states, probs, observation_probs, rewards, terminal_states = tables
+
+    n_states, n_actions, _ = next_states.shape
+    n_observations = observation_probs.shape[2]
+    transition_model = SparseTransitionModel(n_states, n_actions, next_states, probs)
+    if not sparse:
+        transition_model = TransitionModel(n_states, n_actions, transition_model.to_dense())
+    return POMDPModel(
+        n_states,
+        n_actions,
+        n_observations,
+        transition_model=transition_model,
+        observation_model=ObservationModel(n_states, n_actions, n_observations, observation_probs),
+        reward_model=RewardModel(n_states, n_actions, rewards),
+        terminal_states=terminal_states,
+    )
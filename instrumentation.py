@@ -0,0 +1,79 @@
+import time
+import numpy as np
+from typing import Callable, Dict, List
+
+from tree import ArrayTree
+
+"""
+Optional search instrumentation.
+* Per-phase timers and counters, simulation depth histogram and
+observation branching histogram of the tree.
+* Hooks receive the report at the end of every search, e.g. to
+export it to a metrics sink.
+* The agent only checks for None when it is disabled.
+"""
+
+PHASES = ("selection", "expansion", "sampling", "rollout", "backup", "belief_update")
+
+class Instrumentation(object):
+    def __init__(self, hooks: List[Callable[[Dict], None]]=None) -> None:
+        self.hooks = list(hooks) if hooks else []
+        self.reset()
+
+    def reset(self) -> None:
+        self.times = dict.fromkeys(PHASES, 0.)
+        self.counts = dict.fromkeys(PHASES, 0)
+        self.depth_histogram = np.zeros(1, dtype=np.int64)
+        self.nb_searches = 0
+        self.nb_simulations = 0
+        self.search_time = 0.
+
+    def add_hook(self, hook: Callable[[Dict], None]) -> None:
+        self.hooks.append(hook)
+
+    @staticmethod
+    def start() -> float:
+        return time.perf_counter()
+
+    def record(self, phase: str, start_time: float) -> None:
+        self.times[phase] += time.perf_counter() - start_time
+        self.counts[phase] += 1
+
+    def record_depth(self, depth: int) -> None:
+        if depth >= len(self.depth_histogram):
+            histogram = np.zeros(depth + 1, dtype=np.int64)
+            histogram[:len(self.depth_histogram)] = self.depth_histogram
+            self.depth_histogram = histogram
+        self.depth_histogram[depth] += 1
+
+    @staticmethod
+    def branching_histogram(tree: ArrayTree) -> np.ndarray:
+        """
+        Number of action nodes having k observation children, for every k
+        """
+        children = (tree.observation_children[:tree.size] != -1).sum(axis=1)
+        is_action_node = tree.action[:tree.size] != -1
+        return np.bincount(children[is_action_node])
+
+    def end_search(self, nb_simulations: int, search_time: float, tree: ArrayTree) -> Dict:
+        self.nb_searches += 1
+        self.nb_simulations += nb_simulations
+        self.search_time += search_time
+        report = self.report(tree)
+        for hook in self.hooks:
+            hook(report)
+        return report
+
+    def report(self, tree: ArrayTree=None) -> Dict:
+        report = {
+            "nb_searches": self.nb_searches,
+            "nb_simulations": self.nb_simulations,
+            "search_time": self.search_time,
+            "times": dict(self.times),
+            "counts": dict(self.counts),
+            "depth_histogram": self.depth_histogram.tolist(),
+        }
+        if tree is not None:
+            report["tree_size"] = len(tree)
+            report["branching_histogram"] = self.branching_histogram(tree).tolist()
+        return report
@@ -0,0 +1,437 @@
+import numpy as np
+from typing import Tuple
+
+from tree import ArrayTree, NO_NODE, FNV_PRIME
+from belief import ParticleBelief
+from simulator import Simulator
+
+"""
+Iterative POMCP search kernel.
+* Selection, expansion, rollout and backup run as flat loops over the
+ArrayTree arrays and the simulator CDF tables, one batch of simulations
+per call, with no Python object on the way.
+* Compiled with Numba when it is installed, otherwise the same code
+runs as plain NumPy.
+* Uniforms are pre-drawn per simulation: the particle, then four per
+tree step (transition, observation, widened action, routed observation)
+and two per rollout step (action, transition).
+* Progressive widening and the observation slots behave as in
+ArrayTree and POMCPAgent.simulate.
+* Rollouts follow the uniform random policy and stop in terminal states.
+* Particles are recorded for the root and its grandchildren only:
+they are the nodes a real step re-roots to before the next search.
+* Evicted observation subtrees go to the ArrayTree free list, their
+history_index entries and particles are dropped after the batch.
+"""
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+def _jit(function):
+    if numba is None:
+        return function
+    return numba.njit(cache=True)(function)
+
+@_jit
+def _sample(cdf, row, width, uniform):
+    """
+    Outcome of row in a shifted CDF table, see simulator._shifted_cdf
+    """
+    start = row*width
+    outcome = np.searchsorted(cdf[start:start + width], row + uniform, side="right")
+    return min(outcome, width - 1)
+
+@_jit
+def _next_state(successors, transition_cdf, n_actions, n_successors, state, action, uniform):
+    row = state*n_actions + action
+    slot = _sample(transition_cdf, row, n_successors, uniform)
+    if successors.shape[0] == 0:
+        return slot
+    return successors[row, slot]
+
+@_jit
+def _rollout(
+    state, depth, uniforms, offset,
+    successors, transition_cdf, rewards, terminal_states,
+    n_actions, n_successors, max_depth, discount_factor, nb_rollouts,
+):
+    total = 0.
+    for _ in range(nb_rollouts):
+        current = state
+        ret = 0.
+        discount = 1.
+        for _ in range(depth, max_depth):
+            if terminal_states[current]:
+                break
+            action = min(int(uniforms[offset]*n_actions), n_actions - 1)
+            ret += discount*rewards[current, action]
+            current = _next_state(successors, transition_cdf, n_actions, n_successors,
+                                  current, action, uniforms[offset + 1])
+            offset += 2
+            discount *= discount_factor
+        total += ret
+    return total/nb_rollouts
+
+@_jit
+def _add_node(
+    parent_node, node_action, node_observation, label,
+    nb_visits, value, parent, action, observation, history_hash, nb_children,
+    action_children, observation_children, size, free_nodes, nb_free,
+):
+    if nb_free[0] > 0:
+        nb_free[0] -= 1
+        node = free_nodes[nb_free[0]]
+    else:
+        node = size[0]
+        size[0] += 1
+    nb_children[parent_node] += 1
+    nb_children[node] = 0
+    nb_visits[node] = 0
+    value[node] = 0.
+    parent[node] = parent_node
+    action[node] = node_action
+    observation[node] = node_observation
+    history_hash[node] = (history_hash[parent_node] ^ np.uint64(label + 1))*np.uint64(FNV_PRIME)
+    action_children[node, :] = NO_NODE
+    observation_children[node, :] = NO_NODE
+    return node
+
+@_jit
+def _free_subtree(node, action, parent, action_children, observation_children, free_nodes, nb_free):
+    """
+    Puts node and its descendants on the free list, see ArrayTree.free_subtree
+    """
+    first = nb_free[0]
+    free_nodes[nb_free[0]] = node
+    nb_free[0] += 1
+    # The free list itself is the queue of nodes to visit
+    while first < nb_free[0]:
+        node = free_nodes[first]
+        first += 1
+        parent[node] = NO_NODE
+        if action[node] == NO_NODE:
+            children = action_children[node]
+        else:
+            children = observation_children[node]
+        for child in children:
+            if child != NO_NODE:
+                free_nodes[nb_free[0]] = child
+                nb_free[0] += 1
+
+@_jit
+def _add_untried_action(
+    node, uniform, n_actions,
+    nb_visits, value, parent, action, observation, history_hash, nb_children,
+    action_children, observation_children, size, free_nodes, nb_free,
+):
+    """
+    Adds the action child of a missing action drawn uniformly
+    """
+    rank = min(int(uniform*(n_actions - nb_children[node])), n_actions - nb_children[node] - 1)
+    for child_action in range(n_actions):
+        if action_children[node, child_action] == NO_NODE:
+            if rank == 0:
+                action_children[node, child_action] = _add_node(
+                    node, child_action, NO_NODE, child_action,
+                    nb_visits, value, parent, action, observation, history_hash, nb_children,
+                    action_children, observation_children, size, free_nodes, nb_free,
+                )
+                return
+            rank -= 1
+
+@_jit
+def run_simulations(
+    root, root_particles, uniforms,
+    nb_visits, value, parent, action, observation, history_hash, nb_children,
+    action_children, observation_children, size, free_nodes, nb_free, max_nodes,
+    successors, transition_cdf, observation_cdf, rewards, terminal_states,
+    n_states, n_actions, n_observations, n_successors,
+    max_depth, discount_factor, ucb_cst, nb_rollouts,
+    widen_actions, action_k, action_alpha,
+    widen_observations, observation_k, observation_alpha,
+    particle_nodes, particle_states,
+):
+    """
+    Runs one simulation per row of uniforms from root.
+    * size: one element array, grown in place, the arrays must have
+    room for (1 + n_actions + max_depth) nodes per simulation within max_nodes
+    * free_nodes, nb_free: free list of the tree, nodes are taken from
+    it first and evicted subtrees are pushed on it
+    * particle_nodes, particle_states: receive the (node, state) pairs
+    of the root and its grandchildren, two per simulation
+    Returns the number of recorded particles and the number of evictions.
+    """
+    path_nodes = np.empty(max_depth, dtype=np.int64)
+    path_actions = np.empty(max_depth, dtype=np.int64)
+    path_rewards = np.empty(max_depth, dtype=np.float64)
+    nb_particles = 0
+    nb_evicted = 0
+    rollout_offset = 1 + 4*max_depth
+    n_slots = observation_children.shape[1]
+    indexed = n_slots == n_observations
+
+    for simulation in range(uniforms.shape[0]):
+        draws = uniforms[simulation]
+        state = root_particles[min(int(draws[0]*len(root_particles)), len(root_particles) - 1)]
+        node = root
+        depth = 0
+        future = 0.
+        routed = False
+        while depth < max_depth:
+            if depth <= 1 and not routed:
+                particle_nodes[nb_particles] = node
+                particle_states[nb_particles] = state
+                nb_particles += 1
+
+            if nb_children[node] == 0:
+                # Expansion, then leaf evaluation
+                if widen_actions:
+                    if size[0] - nb_free[0] < max_nodes:
+                        _add_untried_action(
+                            node, draws[3 + 4*depth], n_actions,
+                            nb_visits, value, parent, action, observation, history_hash, nb_children,
+                            action_children, observation_children, size, free_nodes, nb_free,
+                        )
+                elif size[0] - nb_free[0] + n_actions <= max_nodes:
+                    for child_action in range(n_actions):
+                        action_children[node, child_action] = _add_node(
+                            node, child_action, NO_NODE, child_action,
+                            nb_visits, value, parent, action, observation, history_hash, nb_children,
+                            action_children, observation_children, size, free_nodes, nb_free,
+                        )
+                future = _rollout(state, depth, draws, rollout_offset,
+                                  successors, transition_cdf, rewards, terminal_states,
+                                  n_actions, n_successors, max_depth, discount_factor, nb_rollouts)
+                break
+
+            if widen_actions and nb_children[node] < n_actions and size[0] - nb_free[0] < max_nodes \
+                    and nb_children[node] <= action_k*nb_visits[node]**action_alpha:
+                _add_untried_action(
+                    node, draws[3 + 4*depth], n_actions,
+                    nb_visits, value, parent, action, observation, history_hash, nb_children,
+                    action_children, observation_children, size, free_nodes, nb_free,
+                )
+
+            # UCB1 selection, unvisited actions first
+            best_child = NO_NODE
+            best_score = -np.inf
+            log_visits = np.log(max(nb_visits[node], 1))
+            for child_action in range(n_actions):
+                child = action_children[node, child_action]
+                if child == NO_NODE:
+                    continue
+                if nb_visits[child] == 0:
+                    best_child = child
+                    break
+                score = value[child] + ucb_cst*np.sqrt(log_visits/nb_visits[child])
+                if score > best_score:
+                    best_score = score
+                    best_child = child
+            best_action = action[best_child]
+
+            next_state = _next_state(successors, transition_cdf, n_actions, n_successors,
+                                     state, best_action, draws[1 + 4*depth])
+            next_observation = _sample(observation_cdf, best_action*n_states + next_state,
+                                       n_observations, draws[2 + 4*depth])
+            path_nodes[depth] = node
+            path_actions[depth] = best_child
+            path_rewards[depth] = rewards[state, best_action]
+
+            next_node = NO_NODE
+            nb_slots_used = nb_children[best_child]
+            if indexed:
+                next_node = observation_children[best_child, next_observation]
+            else:
+                for slot in range(nb_slots_used):
+                    child = observation_children[best_child, slot]
+                    if observation[child] == next_observation:
+                        next_node = child
+                        break
+            routed = False
+            if next_node == NO_NODE and widen_observations and nb_slots_used > 0 \
+                    and nb_slots_used > observation_k*nb_visits[best_child]**observation_alpha:
+                # Existing observation drawn in proportion to its visits
+                total = 0.
+                for slot in range(n_slots):
+                    child = observation_children[best_child, slot]
+                    if child != NO_NODE:
+                        total += nb_visits[child] + 1
+                threshold = draws[4 + 4*depth]*total
+                for slot in range(n_slots):
+                    child = observation_children[best_child, slot]
+                    if child != NO_NODE:
+                        next_node = child
+                        threshold -= nb_visits[child] + 1
+                        if threshold < 0:
+                            break
+                routed = True
+            elif next_node == NO_NODE and (size[0] - nb_free[0] < max_nodes or nb_slots_used == n_slots):
+                slot = next_observation if indexed else nb_slots_used
+                if slot == n_slots:
+                    # Evict the least visited observation child
+                    slot = 0
+                    for other in range(1, n_slots):
+                        if nb_visits[observation_children[best_child, other]] \
+                                < nb_visits[observation_children[best_child, slot]]:
+                            slot = other
+                    evicted = observation_children[best_child, slot]
+                    if depth == 0:
+                        # Drop the particles recorded for it in this batch
+                        for index in range(nb_particles):
+                            if particle_nodes[index] == evicted:
+                                particle_nodes[index] = NO_NODE
+                    _free_subtree(evicted, action, parent, action_children, observation_children,
+                                  free_nodes, nb_free)
+                    nb_children[best_child] -= 1
+                    nb_evicted += 1
+                next_node = _add_node(
+                    best_child, NO_NODE, next_observation, next_observation,
+                    nb_visits, value, parent, action, observation, history_hash, nb_children,
+                    action_children, observation_children, size, free_nodes, nb_free,
+                )
+                observation_children[best_child, slot] = next_node
+            depth += 1
+            state = next_state
+            if next_node == NO_NODE:
+                # The tree is full: evaluate without growing it
+                if depth < max_depth:
+                    future = _rollout(state, depth, draws, rollout_offset,
+                                      successors, transition_cdf, rewards, terminal_states,
+                                      n_actions, n_successors, max_depth, discount_factor, nb_rollouts)
+                break
+            node = next_node
+
+        # Backup
+        ret = future
+        for level in range(depth - 1, -1, -1):
+            ret = path_rewards[level] + discount_factor*ret
+            node = path_nodes[level]
+            child = path_actions[level]
+            nb_visits[node] += 1
+            nb_visits[child] += 1
+            value[child] += (ret - value[child])/nb_visits[child]
+    return nb_particles, nb_evicted
+
+class SearchKernel(object):
+    """
+    Runs batches of simulations of an ArrayTree through run_simulations
+    """
+    def __init__(
+        self,
+        simulator: Simulator,
+        terminal_states: np.ndarray,
+        discount_factor: float,
+        max_depth: int,
+        ucb_cst: float,
+        nb_rollouts: int=1,
+        action_widening: Tuple[float, float]=None,
+        observation_widening: Tuple[float, float]=None,
+    ) -> None:
+        """
+        * action_widening, observation_widening: (k, alpha) progressive
+        widening constants, None to disable
+        """
+        self.simulator = simulator
+        self.successors = simulator.successors
+        if self.successors is None:
+            self.successors = np.empty((0, 0), dtype=np.int64)
+        self.rewards = np.asarray(simulator.rewards, dtype=np.float64)
+        if terminal_states is None:
+            terminal_states = np.zeros(simulator.n_states, dtype=bool)
+        self.terminal_states = np.asarray(terminal_states, dtype=bool)
+        self.discount_factor = float(discount_factor)
+        self.max_depth = int(max_depth)
+        self.ucb_cst = float(ucb_cst)
+        self.nb_rollouts = int(nb_rollouts)
+        self.action_widening = action_widening
+        self.observation_widening = observation_widening
+        self.size = np.zeros(1, dtype=np.int64)
+        self.nb_free = np.zeros(1, dtype=np.int64)
+        if NUMBA_AVAILABLE:
+            self.warm_up()
+
+    def warm_up(self) -> None:
+        """
+        Compiles the kernel (or loads it from the Numba cache) on a
+        throwaway tree, outside of any search time budget
+        """
+        tree = ArrayTree(self.simulator.n_actions, self.simulator.n_observations, max_observation_children=1)
+        particles = ParticleBelief(1)
+        particles.add(0)
+        self._run(tree, tree.root, particles, np.zeros((1, self.nb_uniforms)))
+
+    @property
+    def nb_uniforms(self) -> int:
+        return 1 + 4*self.max_depth + 2*self.max_depth*self.nb_rollouts
+
+    def run(self, tree: ArrayTree, root: int, root_particles: ParticleBelief, nb_simulations: int) -> int:
+        """
+        Returns the number of simulations run
+        """
+        if nb_simulations <= 0 or len(root_particles) == 0:
+            return 0
+        uniforms = self.simulator.uniforms.take((nb_simulations, self.nb_uniforms))
+        self._run(tree, root, root_particles, uniforms)
+        return nb_simulations
+
+    def _run(self, tree: ArrayTree, root: int, root_particles: ParticleBelief, uniforms: np.ndarray) -> None:
+        nb_simulations = len(uniforms)
+        tree.reserve(nb_simulations*(1 + tree.n_actions + self.max_depth))
+        max_nodes = tree.capacity
+        particle_nodes = np.empty(2*nb_simulations, dtype=np.int64)
+        particle_states = np.empty(2*nb_simulations, dtype=np.int64)
+        self.size[0] = previous_size = tree.size
+        self.nb_free[0] = previous_free = tree.nb_free
+        capped = tree.observation_slots < tree.n_observations
+        if capped:
+            previous_hashes = tree.history_hash[:previous_size].copy()
+            previously_free = tree.free_nodes[:previous_free].copy()
+        simulator = self.simulator
+        action_k, action_alpha = self.action_widening or (0., 0.)
+        observation_k, observation_alpha = self.observation_widening or (0., 0.)
+
+        with np.errstate(over="ignore"):
+            nb_particles, nb_evicted = run_simulations(
+                root, root_particles.get_particles, uniforms,
+                tree.nb_visits, tree.value, tree.parent, tree.action, tree.observation, tree.history_hash,
+                tree.nb_children, tree.action_children, tree.observation_children,
+                self.size, tree.free_nodes, self.nb_free, max_nodes,
+                self.successors, simulator.transition_cdf, simulator.observation_cdf,
+                self.rewards, self.terminal_states,
+                simulator.n_states, simulator.n_actions, simulator.n_observations, simulator.n_successors,
+                self.max_depth, self.discount_factor, self.ucb_cst, self.nb_rollouts,
+                self.action_widening is not None, float(action_k), float(action_alpha),
+                self.observation_widening is not None, float(observation_k), float(observation_alpha),
+                particle_nodes, particle_states,
+            )
+
+        tree.size = int(self.size[0])
+        tree.nb_free = int(self.nb_free[0])
+        added = np.arange(previous_size, tree.size)
+        if capped and (nb_evicted > 0 or previous_free > 0):
+            # Old nodes freed or reused by the batch lose their entries,
+            # a reused node may get back the hash it had when freed
+            free = np.zeros(tree.size, dtype=bool)
+            free[tree.free_nodes[:tree.nb_free]] = True
+            changed = (tree.history_hash[:previous_size] != previous_hashes) | free[:previous_size]
+            changed[previously_free] = True
+            changed = np.flatnonzero(changed)
+            for node, node_hash in zip(changed.tolist(), previous_hashes[changed].tolist()):
+                if tree.history_index.get(node_hash) == node:
+                    del tree.history_index[node_hash]
+                tree.particles.pop(node, None)
+            added = np.concatenate((changed, added))
+            added = added[~free[added]]
+        tree.history_index.update(zip(tree.history_hash[added].tolist(), added.tolist()))
+        # Particles, grouped by node
+        recorded = particle_nodes[:nb_particles]
+        keep = recorded != NO_NODE
+        particle_nodes, particle_states = recorded[keep], particle_states[:nb_particles][keep]
+        order = np.argsort(particle_nodes, kind="stable")
+        nodes, starts = np.unique(particle_nodes[order], return_index=True)
+        for node, states in zip(nodes.tolist(), np.split(particle_states[order], starts[1:])):
+            tree.get_particles(node).extend(states)
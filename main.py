@@ -1,14 +1,14 @@
 from grid import make_env
 from agent import POMCPAgent
-from pomdp import make_pomdp_model
-from generator import Generator
+from grid_model import compile_grid_model
 
 if __name__ == "__main__":
     print("Start")
-    pomdp_model = make_pomdp_model()
-    env = make_env(pomdp_model)
+    env = make_env()
     obs = env.reset()
     print(obs)
+    # Plan on the real dynamics of the generated layout
+    env.set_pomdp_model(compile_grid_model(env))
     agent = POMCPAgent(env)
     print("Planning starts")
     action = agent.take_action()
@@ -0,0 +1,115 @@
+import json
+import struct
+import numpy as np
+from typing import Dict
+
+from pomdp import (
+    POMDPModel,
+    TransitionModel,
+    SparseTransitionModel,
+    ObservationModel,
+    RewardModel,
+)
+from simulator import sampling_tables
+
+"""
+Binary POMDP model files, memory-mapped on load.
+* Layout: MAGIC, header length (uint64, little endian), JSON header,
+then the raw arrays, each one starting on an ALIGNMENT byte boundary.
+* The header holds the model sizes, the transition model kind and
+the dtype, shape and offset of every array.
+* The simulator tables are stored too, so loading copies nothing:
+processes loading the same file share one read-only copy through
+the page cache.
+"""
+
+MAGIC = b"POMDPMM1"
+ALIGNMENT = 64
+
+def _align(offset: int) -> int:
+    return -(-offset//ALIGNMENT)*ALIGNMENT
+
+def _model_arrays(model: POMDPModel) -> Dict[str, np.ndarray]:
+    transition_model = model.get_transition_model
+    if isinstance(transition_model, SparseTransitionModel):
+        arrays = {"next_states": transition_model.next_states, "probs": transition_model.probs}
+    else:
+        arrays = {"transition_probs": transition_model.transition_probs}
+    arrays["observation_probs"] = model.get_observation_model.observation_probs
+    arrays["rewards"] = model.get_reward_model.rewards
+    if model.terminal_states is not None:
+        arrays["terminal_states"] = model.terminal_states
+    _, arrays["transition_cdf"], arrays["observation_cdf"] = (
+        model.sampling_tables if model.sampling_tables is not None else sampling_tables(model)
+    )
+    return {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+def save_model(model: POMDPModel, path: str) -> None:
+    arrays = _model_arrays(model)
+    header = {
+        "n_states": model.get_nb_states,
+        "n_actions": model.get_nb_actions,
+        "n_observations": model.get_nb_observations,
+        "sparse": "next_states" in arrays,
+        "arrays": {},
+    }
+    # Offsets depend on the header length, which depends on the offsets:
+    # lay the arrays out after a header with room for the largest offsets
+    placeholder = {name: {"dtype": array.dtype.str, "shape": array.shape, "offset": 2**63}
+                   for name, array in arrays.items()}
+    data_start = _align(len(MAGIC) + 8 + len(json.dumps(dict(header, arrays=placeholder))))
+    offset = data_start
+    for name, array in arrays.items():
+        header["arrays"][name] = {"dtype": array.dtype.str, "shape": array.shape, "offset": offset}
+        offset = _align(offset + array.nbytes)
+    encoded = json.dumps(header).encode()
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(encoded)))
+        f.write(encoded)
+        for name, array in arrays.items():
+            f.write(b"\0"*(header["arrays"][name]["offset"] - f.tell()))
+            f.write(array.tobytes())
+
+def read_header(path: str) -> Dict:
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a POMDP model file")
+        header_length, = struct.unpack("<Q", f.read(8))
+        return json.loads(f.read(header_length))
+
+def load_model(path: str, mmap: bool=True) -> POMDPModel:
+    """
+    * mmap: map the arrays read-only instead of reading them in memory
+    """
+    header = read_header(path)
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype, shape = np.dtype(spec["dtype"]), tuple(spec["shape"])
+        if mmap:
+            arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=spec["offset"], shape=shape)
+        else:
+            arrays[name] = np.fromfile(path, dtype=dtype, count=int(np.prod(shape)),
+                                       offset=spec["offset"]).reshape(shape)
+
+    n_states, n_actions, n_observations = header["n_states"], header["n_actions"], header["n_observations"]
+    successors = None
+    if header["sparse"]:
+        transition_model = SparseTransitionModel(n_states, n_actions, arrays["next_states"], arrays["probs"])
+        successors = arrays["next_states"].reshape(n_states*n_actions, -1)
+    else:
+        transition_model = TransitionModel(n_states, n_actions, arrays["transition_probs"])
+    model = POMDPModel(
+        n_states,
+        n_actions,
+        n_observations,
+        transition_model=transition_model,
+        observation_model=ObservationModel(n_states, n_actions, n_observations, arrays["observation_probs"]),
+        reward_model=RewardModel(n_states, n_actions, arrays["rewards"]),
+        terminal_states=arrays.get("terminal_states"),
+    )
+    model.sampling_tables = successors, arrays["transition_cdf"], arrays["observation_cdf"]
+    if mmap:
+        model.path = path
+    return model
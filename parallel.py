@@ -0,0 +1,265 @@
+import os
+import copy
+import time
+import threading
+import multiprocessing
+import numpy as np
+from typing import Dict, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from tree import NO_NODE, best_tried_action
+from rng import UniformBlock, spawn_rngs
+
+"""
+Parallel POMCP search.
+* Root parallelization: every worker process builds its own tree from
+its own share of the root particles, root action statistics are merged.
+* Tree parallelization: worker threads share one tree, a virtual loss on
+the actions being simulated spreads the threads over the tree.
+* Both stop early when the agent stop_event is set: root workers are
+told through a process-shared event.
+"""
+
+# Agent copy living in each worker process
+_worker_agent = None
+# Set by the main process to stop the running searches
+_worker_stop_event = None
+# Seconds between two checks of the agent stop_event while workers run
+STOP_POLL_PERIOD = 0.05
+
+def _init_worker(agent, stop_event) -> None:
+    global _worker_agent, _worker_stop_event
+    _worker_agent = agent
+    _worker_stop_event = stop_event
+
+def _root_search(
+    root_particles: np.ndarray,
+    seed: np.random.SeedSequence,
+    time_out: float,
+    nb_simulations: int,
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    Runs in a worker process.
+    Returns root visits and values per action, and the number of simulations.
+    """
+    from generator import Generator
+    agent = _worker_agent
+    rng = np.random.default_rng(seed)
+    agent.generator = agent.rollout_engine.simulator = Generator(agent.pomdp_model, rng)
+    agent.rollout_engine.policy.set_rng(rng)
+    if agent.rollout_engine.cache is not None:
+        agent.rollout_engine.cache.set_rng(rng)
+    agent.search_kernel = agent.make_kernel() if agent.use_kernel else None
+    uniforms = agent.uniforms = UniformBlock(rng)
+    agent.search_tree = agent.make_search_tree()
+    tree = agent.search_tree.tree
+    root = tree.root
+
+    start_time = time.time()
+    nb_done = 0
+    if agent.search_kernel is not None:
+        from agent import KERNEL_BATCH
+        from belief import ParticleBelief
+        particles = ParticleBelief(len(root_particles))
+        particles.extend(root_particles)
+        while nb_done < nb_simulations and time.time() - start_time < time_out \
+                and not _worker_stop_event.is_set():
+            nb_done += agent.search_kernel.run(tree, root, particles, min(KERNEL_BATCH, nb_simulations - nb_done))
+    while nb_done < nb_simulations and time.time() - start_time < time_out \
+            and not _worker_stop_event.is_set():
+        state = root_particles[uniforms.integers(len(root_particles))]
+        agent.simulate(int(state), root, depth=0)
+        nb_done += 1
+    visits, values = tree.action_statistics(root)
+    return visits, values, nb_done
+
+def merge_root_statistics(visits: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    * visits, values: (nb_workers, n_actions)
+    Returns the summed visits and the visit-weighted mean values.
+    """
+    total_visits = visits.sum(axis=0)
+    merged_values = (visits*values).sum(axis=0)/np.maximum(total_visits, 1)
+    return total_visits, merged_values
+
+class RootParallelSearch(object):
+    def __init__(
+        self,
+        agent,
+        nb_workers: int=None,
+        seed: Union[int, np.random.SeedSequence]=0,
+    ) -> None:
+        """
+        * agent: POMCPAgent whose parameters and model are copied once to every worker
+        * seed: root of the SeedSequence spawning one stream per worker and per search
+        """
+        self.nb_workers = nb_workers or os.cpu_count()
+        self.seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.stop_event = agent.stop_event
+        self.worker_stop_event = multiprocessing.Event()
+        self.pool = ProcessPoolExecutor(
+            self.nb_workers,
+            initializer=_init_worker,
+            initargs=(agent, self.worker_stop_event),
+        )
+        self.nb_simulations = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def search(
+        self,
+        root_particles: np.ndarray,
+        time_out: float=np.inf,
+        nb_simulations: int=None,
+    ) -> Tuple[int, np.ndarray, np.ndarray]:
+        """
+        * nb_simulations: total budget shared by the workers (None for time only)
+        Returns the best action and the merged root visits and values.
+        """
+        if nb_simulations is None:
+            budgets = [np.iinfo(np.int64).max]*self.nb_workers
+        else:
+            budgets = [len(share) for share in np.array_split(np.arange(nb_simulations), self.nb_workers)]
+        seeds = self.seed_sequence.spawn(self.nb_workers)
+        futures = [
+            self.pool.submit(_root_search, root_particles, seed, time_out, budget)
+            for seed, budget in zip(seeds, budgets)
+        ]
+        pending = futures
+        while pending:
+            _, pending = wait(pending, timeout=STOP_POLL_PERIOD)
+            if self.stop_event.is_set():
+                self.worker_stop_event.set()
+        results = [future.result() for future in futures]
+        self.worker_stop_event.clear()
+        visits = np.stack([result[0] for result in results])
+        values = np.stack([result[1] for result in results])
+        self.nb_simulations = sum(result[2] for result in results)
+        visits, values = merge_root_statistics(visits, values)
+        return best_tried_action(visits, values), visits, values
+
+    def close(self) -> None:
+        self.pool.shutdown()
+
+class TreeParallelSearch(object):
+    """
+    Threads share the agent tree. The Python parts of a simulation hold
+    the GIL, so this pays off only when simulation cost is dominated by
+    code releasing it (NumPy kernels, compiled simulators).
+    * Every thread has its own simulator and rollout streams, spawned
+    from the agent generator. Thread interleaving still makes the tree
+    order dependent, tree-parallel runs are not reproducible.
+    """
+    def __init__(
+        self,
+        agent,
+        nb_workers: int=None,
+        virtual_loss: float=1.,
+    ) -> None:
+        self.agent = agent
+        self.nb_workers = nb_workers or os.cpu_count()
+        self.virtual_loss = virtual_loss
+        self.lock = threading.Lock()
+        # Number of simulations currently going through each action node
+        self.in_flight: Dict[int, int] = {}
+        self.nb_simulations = 0
+
+    def _select(self, node: int) -> int:
+        """
+        UCB1 where each in-flight simulation counts as a visit that lost
+        virtual_loss
+        """
+        tree = self.agent.search_tree.tree
+        children = tree.action_children[node]
+        pending = np.array([self.in_flight.get(int(child), 0) for child in children])
+        visits = tree.nb_visits[children] + pending
+        if np.any(visits == 0):
+            child = int(children[np.argmin(visits)])
+        else:
+            values = (tree.value[children]*tree.nb_visits[children] - self.virtual_loss*pending)/visits
+            node_visits = max(tree.nb_visits[node] + pending.sum(), 1)
+            scores = values + self.agent.ucb_cst*np.sqrt(np.log(node_visits)/visits)
+            child = int(children[np.argmax(scores)])
+        self.in_flight[child] = self.in_flight.get(child, 0) + 1
+        return child
+
+    def _thread_streams(self, rng: np.random.Generator):
+        """
+        Simulator and rollout engine of one thread
+        """
+        from generator import Generator
+        generator = Generator(self.agent.pomdp_model, rng)
+        rollout_engine = copy.copy(self.agent.rollout_engine)
+        rollout_engine.simulator = generator
+        rollout_engine.policy = copy.copy(rollout_engine.policy)
+        rollout_engine.policy.set_rng(rng)
+        return generator, rollout_engine
+
+    def simulate(self, state: int, node: int, depth: int, generator=None, rollout_engine=None) -> float:
+        agent = self.agent
+        generator = agent.generator if generator is None else generator
+        rollout_engine = agent.rollout_engine if rollout_engine is None else rollout_engine
+        tree = agent.search_tree.tree
+        if depth >= agent.max_depth:
+            return 0
+
+        with self.lock:
+            tree.get_particles(node).add(state)
+            is_leaf = tree.is_leaf(node)
+            if is_leaf:
+                tree.expand(node)
+            else:
+                best_child = self._select(node)
+                best_action = int(tree.action[best_child])
+        if is_leaf:
+            return rollout_engine.evaluate(state, depth)
+
+        next_state, next_obs, reward = generator(state, best_action)
+        with self.lock:
+            next_node = tree.observation_child(best_child, next_obs)
+            if next_node == NO_NODE:
+                next_node = tree.add_observation_child(best_child, next_obs)
+        if next_node == NO_NODE:
+            future = rollout_engine.evaluate(next_state, depth+1)
+        else:
+            future = self.simulate(next_state, next_node, depth+1, generator, rollout_engine)
+        ret = reward + agent.discout_factor*future
+
+        with self.lock:
+            self.in_flight[best_child] -= 1
+            tree.backup(node, best_child, ret)
+        return ret
+
+    def search(
+        self,
+        root: int,
+        root_particles,
+        time_out: float=np.inf,
+        nb_simulations: int=None,
+    ) -> int:
+        budget = np.iinfo(np.int64).max if nb_simulations is None else nb_simulations
+        counter = {"done": 0}
+        start_time = time.time()
+
+        def work(rng: np.random.Generator) -> None:
+            generator, rollout_engine = self._thread_streams(rng)
+            uniforms = UniformBlock(rng)
+            while time.time() - start_time < time_out and not self.agent.stop_event.is_set():
+                with self.lock:
+                    if counter["done"] >= budget:
+                        return
+                    counter["done"] += 1
+                    state = root_particles.sample(uniforms)
+                self.simulate(state, root, 0, generator, rollout_engine)
+
+        threads = [threading.Thread(target=work, args=(rng,)) for rng in spawn_rngs(self.agent.rng, self.nb_workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.nb_simulations = counter["done"]
+        return self.agent.search_tree.tree.best_action(root)
@@ -0,0 +1,213 @@
+import time
+import numpy as np
+from typing import Tuple
+
+from grid import Grid
+from pomdp import POMDPModel, SparseTransitionModel
+from simulator import Simulator
+from belief import BeliefUpdater, uniform_belief
+
+"""
+Offline point-based value iteration (PBVI, Perseus style).
+* Belief points are collected by batches of random walks through the
+exact belief filter.
+* Every iteration backs up all the belief points at once:
+    * alpha_{a,z,k}(s) = sum_s' T(s, a, s') * O(a, s', z) * alpha_k(s')
+    * alpha_{b,a} = R(., a) + gamma * sum_z argmax_k <b, alpha_{a,z,k}>
+    * alpha_b = argmax_a <b, alpha_{b,a}>
+A point keeps its previous alpha vector when the backup does not
+improve its value, so the value function never decreases.
+* The solver builds the dense (A, Z, S, S) backup tensor: it targets
+small to medium grids.
+"""
+
+class PBVIPolicy(object):
+    """
+    Alpha vector policy: action of the alpha vector maximizing <b, alpha>.
+    Acts like POMCPAgent once given an environment.
+    """
+    def __init__(
+        self,
+        alphas: np.ndarray,
+        actions: np.ndarray,
+        env: Grid=None,
+        init_belief: np.ndarray=None,
+        discount_factor: float=0.99,
+        verbose: bool=True,
+    ) -> None:
+        """
+        * alphas: (n_alphas, n_states) alpha vectors
+        * actions: (n_alphas,) action of each alpha vector
+        """
+        self.alphas = np.asarray(alphas, dtype=np.float64)
+        self.actions = np.asarray(actions, dtype=np.int64)
+        self.discout_factor = discount_factor
+        self.verbose = verbose
+        self.init_belief = init_belief
+        self.env = None
+        if env is not None:
+            self.set_env(env)
+
+    def set_env(self, env: Grid) -> None:
+        self.env = env
+        self.belief_updater = BeliefUpdater(env.transition_model, env.observation_model)
+        if self.init_belief is not None:
+            self.current_belief = np.asarray(self.init_belief, dtype=np.float64)
+        else:
+            self.current_belief = uniform_belief(env.get_number_states)
+        self.previous_belief = None
+        self.history = []
+        self.last_reward = 0.
+        self.total_reward = 0.
+        self.done = False
+
+    def value(self, belief: np.ndarray) -> float:
+        return float(np.max(self.alphas @ belief))
+
+    def best_action(self, belief: np.ndarray) -> int:
+        return int(self.actions[np.argmax(self.alphas @ belief)])
+
+    def update_belief(self, action: str, observation: Tuple):
+        self.previous_belief = self.current_belief
+        self.current_belief = self.belief_updater.update(
+            self.current_belief,
+            self.env.action_str2int(action),
+            self.env.observation2int(observation),
+        )
+
+    def take_action(self) -> str:
+        if self.env.is_in_goal:
+            if self.verbose:
+                print(f"I am in goal state. I got {self.total_reward} as total reward.")
+                print(f"I will not execute any other action.")
+            return
+        action = self.env.action_int2str(self.best_action(self.current_belief))
+        if self.verbose:
+            print(f"Action planned: {action}")
+        reward, new_obs, done = self.env.step(action)
+        self.total_reward = reward + self.discout_factor*self.total_reward
+        self.last_reward = reward
+        self.done = done
+        self.update_belief(action, new_obs)
+        self.history.append(self.env.action_str2int(action))
+        self.history.append(self.env.observation2int(new_obs))
+        return action
+
+    def close(self) -> None:
+        pass
+
+    def save(self, path: str) -> None:
+        np.savez(path, alphas=self.alphas, actions=self.actions, discount_factor=self.discout_factor)
+
+    @classmethod
+    def load(cls, path: str, env: Grid=None, **params) -> "PBVIPolicy":
+        with np.load(path) as saved:
+            return cls(saved["alphas"], saved["actions"], env,
+                       discount_factor=float(saved["discount_factor"]), **params)
+
+class PBVISolver(object):
+    def __init__(
+        self,
+        pomdp_model: POMDPModel,
+        discount_factor: float=0.99,
+        init_belief: np.ndarray=None,
+        nb_beliefs: int=512,
+        max_depth: int=20,
+        seed: int=None,
+    ) -> None:
+        """
+        * nb_beliefs: belief points collected by random walks
+        * max_depth: length of each random walk
+        """
+        self.pomdp_model = pomdp_model
+        self.discount_factor = discount_factor
+        self.init_belief = init_belief if init_belief is not None else uniform_belief(pomdp_model.get_nb_states)
+        self.nb_beliefs = nb_beliefs
+        self.max_depth = max_depth
+        self.rng = np.random.default_rng(seed)
+
+        transition_model = pomdp_model.get_transition_model
+        if isinstance(transition_model, SparseTransitionModel):
+            transition_probs = transition_model.to_dense()
+        else:
+            transition_probs = transition_model.transition_probs
+        observation_probs = pomdp_model.get_observation_model.observation_probs
+        # backup_tensor[a, z, s, s'] = T(s, a, s') * O(a, s', z)
+        self.backup_tensor = np.einsum("sat,atz->azst", transition_probs, observation_probs)
+        self.rewards = np.asarray(pomdp_model.get_reward_model.rewards, dtype=np.float64)
+        self.belief_updater = BeliefUpdater(transition_model, pomdp_model.get_observation_model)
+        self.beliefs = None
+        self.nb_iterations = 0
+
+    def collect_beliefs(self) -> np.ndarray:
+        """
+        Distinct beliefs reached by random walks from the initial belief
+        """
+        simulator = Simulator(self.pomdp_model, self.rng)
+        n_states, n_actions = self.pomdp_model.get_nb_states, self.pomdp_model.get_nb_actions
+        nb_walks = -(-self.nb_beliefs//self.max_depth)
+        beliefs = np.tile(self.init_belief, (nb_walks, 1))
+        states = self.rng.choice(n_states, size=nb_walks, p=self.init_belief)
+        collected = [self.init_belief[None, :]]
+        for _ in range(self.max_depth):
+            actions = self.rng.integers(n_actions, size=nb_walks)
+            states, observations, _ = simulator.step(states, actions)
+            beliefs = self.belief_updater.update_batch(beliefs, actions, observations)
+            collected.append(beliefs)
+        beliefs = np.concatenate(collected)
+        _, unique = np.unique(beliefs.round(8), axis=0, return_index=True)
+        return beliefs[np.sort(unique)]
+
+    def backup(self, beliefs: np.ndarray, alphas: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Point-based backup of all the beliefs at once
+        Returns the backed-up alpha vector and its action for each belief
+        """
+        n_actions, n_observations = self.backup_tensor.shape[:2]
+        # projections[a, z, s, k] = alpha_{a,z,k}(s)
+        projections = self.backup_tensor @ alphas.T
+        # best[a, z, b] = argmax_k <b, alpha_{a,z,k}>
+        best = np.argmax(beliefs @ projections, axis=3)
+        # backed_up[a, b, s] = R(s, a) + gamma * sum_z alpha_{a,z,best}(s)
+        backed_up = np.take_along_axis(
+            projections.transpose(0, 1, 3, 2),
+            best[..., None],
+            axis=2,
+        ).sum(axis=1)
+        backed_up = self.rewards.T[:, None, :] + self.discount_factor*backed_up
+        values = np.einsum("abs,bs->ab", backed_up, beliefs)
+        actions = np.argmax(values, axis=0)
+        return backed_up[actions, np.arange(len(beliefs))], actions
+
+    def solve(self, max_iterations: int=100, epsilon: float=1e-3, time_out: float=None) -> PBVIPolicy:
+        """
+        Iterates until the values of the belief points change by less
+        than epsilon, max_iterations or time_out seconds
+        """
+        if self.beliefs is None:
+            self.beliefs = self.collect_beliefs()
+        beliefs = self.beliefs
+        alphas = np.full((1, self.pomdp_model.get_nb_states), self.rewards.min()/(1 - self.discount_factor))
+        actions = np.zeros(1, dtype=np.int64)
+        values = np.max(beliefs @ alphas.T, axis=1)
+
+        start_time = time.time()
+        self.nb_iterations = 0
+        while self.nb_iterations < max_iterations:
+            new_alphas, new_actions = self.backup(beliefs, alphas)
+            new_values = np.einsum("bs,bs->b", new_alphas, beliefs)
+            # Keep the previous alpha vector where the backup does not improve
+            previous = np.argmax(beliefs @ alphas.T, axis=1)
+            worse = new_values < values
+            new_alphas[worse] = alphas[previous[worse]]
+            new_actions[worse] = actions[previous[worse]]
+            new_values[worse] = values[worse]
+
+            alphas, unique = np.unique(new_alphas, axis=0, return_index=True)
+            actions = new_actions[unique]
+            change = np.max(np.abs(new_values - values))
+            values = new_values
+            self.nb_iterations += 1
+            if change < epsilon or (time_out is not None and time.time() - start_time > time_out):
+                break
+        return PBVIPolicy(alphas, actions, discount_factor=self.discount_factor)
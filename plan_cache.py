@@ -0,0 +1,104 @@
+import os
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from typing import Tuple
+
+"""
+Plan cache: root action statistics per belief, across searches and episodes.
+* Beliefs are keyed by their support and their vector quantized to
+resolution (relative to its largest probability), so the same belief
+reached through different histories shares its entry.
+* An entry holds the visits and values of the root actions of the
+last search from that belief. Searches warm-start from it, or are
+skipped when it has skip_visits visits.
+* Least recently used entries are evicted past capacity.
+* Caches are saved to and loaded from npz files between runs. A cache
+only makes sense for one model: keep one file per model.
+"""
+
+def belief_key(belief: np.ndarray, resolution: float=1e-3) -> str:
+    """
+    Hash of the number of states, the support and the probabilities
+    quantized relative to the largest one: diffuse beliefs never
+    collapse to a shared all-zero vector
+    """
+    belief = np.asarray(belief, dtype=np.float64)
+    quantized = np.rint(belief/(belief.max()*resolution)).astype(np.int32)
+    key = hashlib.blake2b(digest_size=16)
+    key.update(np.int64(len(belief)).tobytes())
+    key.update(np.packbits(belief > 0).tobytes())
+    key.update(quantized.tobytes())
+    return key.hexdigest()
+
+class PlanCache(object):
+    def __init__(self, capacity: int=10000, resolution: float=1e-3, skip_visits: int=None) -> None:
+        """
+        * resolution: quantization step of the belief probabilities,
+        relative to the largest one
+        * skip_visits: cached root visits above which the search is
+        skipped (None always searches, warm-started)
+        """
+        self.capacity = capacity
+        self.resolution = resolution
+        self.skip_visits = skip_visits
+        # belief key -> (visits, values) of the root actions
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def lookup(self, belief: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Cached (visits, values), None for an unknown belief
+        """
+        key = belief_key(belief, self.resolution)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def is_decided(self, visits: np.ndarray) -> bool:
+        return self.skip_visits is not None and visits.sum() >= self.skip_visits
+
+    def store(self, belief: np.ndarray, visits: np.ndarray, values: np.ndarray) -> None:
+        """
+        Replaces the entry of belief, the statistics of a warm-started
+        search already include the cached ones
+        """
+        key = belief_key(belief, self.resolution)
+        self.entries[key] = (np.array(visits, dtype=np.int64), np.array(values, dtype=np.float64))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+    def save(self, path: str) -> None:
+        if not self.entries:
+            np.savez(path, keys=np.array([], dtype=str), resolution=self.resolution)
+            return
+        visits, values = zip(*self.entries.values())
+        np.savez(path, keys=np.array(list(self.entries)), visits=np.stack(visits),
+                 values=np.stack(values), resolution=self.resolution)
+
+    @classmethod
+    def load(cls, path: str, capacity: int=10000, skip_visits: int=None) -> "PlanCache":
+        """
+        Empty cache when the file does not exist yet
+        """
+        if not os.path.exists(path):
+            return cls(capacity, skip_visits=skip_visits)
+        with np.load(path) as saved:
+            cache = cls(capacity, float(saved["resolution"]), skip_visits)
+            # Most recently used last, as saved
+            for i, key in enumerate(saved["keys"][-capacity:], start=max(len(saved["keys"]) - capacity, 0)):
+                cache.entries[str(key)] = (saved["visits"][i], saved["values"][i])
+        return cache
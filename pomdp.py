@@ -1,6 +1,7 @@
 import numpy as np
 
 import config
+from rng import make_rng
 
 """
 POMDP: <S, A, Z, T, R, O>, where:
@@ -20,7 +21,7 @@ class TransitionModel:
     def __init__(self, n_states, n_actions, transition_probs=None):
         self.n_states = n_states
         self.n_actions = n_actions
-        if not transition_probs:
+        if transition_probs is None:
             self.transition_probs = np.full((n_states, n_actions, n_states), 1/n_states)
         else:
             shape = transition_probs.shape
@@ -35,15 +36,117 @@ class TransitionModel:
     def get_transition_prob(self, state, action, next_state):
         return self.transition_probs[state, action, next_state]
 
-    def sample_state(self, state, action):
-        return np.random.choice(self.n_states, p=self.transition_probs[state, action, :])
+    def sample_state(self, state, action, rng=None):
+        return make_rng(rng).choice(self.n_states, p=self.transition_probs[state, action, :])
+
+    def successors(self):
+        """
+        (next_states, probs), both (n_states, n_actions, n_successors)
+        * next_states is None when slot k is state k, as here
+        """
+        return None, self.transition_probs
+
+    def propagate(self, weights, action):
+        """
+        sum_s T(s, a, .) * weights(s), restricted to the support of weights
+        """
+        support = np.flatnonzero(weights)
+        return weights[support] @ self.transition_probs[support, action, :]
+
+    def propagate_batch(self, weights, actions):
+        """
+        * weights: (n_batch, n_states), actions: (n_batch,)
+        """
+        return np.einsum("bs,sbt->bt", weights, self.transition_probs[:, actions, :])
+
+class SparseTransitionModel:
+    """
+    Each (state, action) reaches at most n_successors states:
+    * next_states[s, a, k]: k-th successor of s under a
+    * probs[s, a, k]: its probability (0 for unused slots)
+    Memory is linear in the number of states.
+    """
+    def __init__(self, n_states, n_actions, next_states, probs):
+        if next_states.shape != probs.shape or next_states.shape[:2] != (n_states, n_actions):
+            raise ValueError(f"Successor tables should be (n_states, n_actions, n_successors)")
+        self.n_states = n_states
+        self.n_actions = n_actions
+        self.next_states = next_states.astype(np.int64, copy=False)
+        self.probs = probs.astype(np.float64, copy=False)
+
+    @classmethod
+    def from_dense(cls, transition_probs):
+        n_states, n_actions, _ = transition_probs.shape
+        n_successors = max(int((transition_probs > 0).sum(axis=2).max()), 1)
+        # Largest probabilities first, zero slots last
+        order = np.argsort(-transition_probs, axis=2, kind="stable")[:, :, :n_successors]
+        probs = np.take_along_axis(transition_probs, order, axis=2)
+        return cls(n_states, n_actions, order, probs)
+
+    def to_dense(self):
+        transition_probs = np.zeros((self.n_states, self.n_actions, self.n_states))
+        states, actions, _ = np.indices(self.next_states.shape)
+        np.add.at(transition_probs, (states, actions, self.next_states), self.probs)
+        return transition_probs
+
+    @property
+    def n_successors(self):
+        return self.next_states.shape[2]
+
+    def _slot(self, state, action, next_state):
+        slots = np.flatnonzero((self.next_states[state, action] == next_state) & (self.probs[state, action] > 0))
+        return int(slots[0]) if len(slots) else None
+
+    def set_transition(self, state, action, next_state, probability):
+        slot = self._slot(state, action, next_state)
+        if slot is None:
+            free = np.flatnonzero(self.probs[state, action] == 0)
+            if len(free) == 0:
+                raise ValueError(f"No free successor slot for state {state} and action {action}")
+            slot = int(free[0])
+            self.next_states[state, action, slot] = next_state
+        self.probs[state, action, slot] = probability
+
+    def get_transition_prob(self, state, action, next_state):
+        mask = self.next_states[state, action] == next_state
+        return self.probs[state, action][mask].sum()
+
+    def sample_state(self, state, action, rng=None):
+        probs = self.probs[state, action]
+        return int(self.next_states[state, action, make_rng(rng).choice(len(probs), p=probs)])
+
+    def successors(self):
+        return self.next_states, self.probs
+
+    def propagate(self, weights, action):
+        support = np.flatnonzero(weights)
+        return np.bincount(
+            self.next_states[support, action].ravel(),
+            weights=(weights[support, None]*self.probs[support, action]).ravel(),
+            minlength=self.n_states,
+        )
+
+    def propagate_batch(self, weights, actions):
+        n_batch = len(weights)
+        # Row b of the result is offset by b*n_states
+        next_states = self.next_states[:, actions, :] + (np.arange(n_batch)*self.n_states)[None, :, None]
+        flat = np.bincount(
+            next_states.ravel(),
+            weights=(weights.T[:, :, None]*self.probs[:, actions, :]).ravel(),
+            minlength=n_batch*self.n_states,
+        )
+        return flat.reshape(n_batch, self.n_states)
 
 class ObservationModel:
-    def __init__(self, n_states, n_actions, n_observations):
+    def __init__(self, n_states, n_actions, n_observations, observation_probs=None):
         self.n_states = n_states
         self.n_actions = n_actions
         self.n_observations = n_observations
-        self.observation_probs = np.full((n_actions, n_states, n_observations), 1/n_observations)
+        if observation_probs is None:
+            self.observation_probs = np.full((n_actions, n_states, n_observations), 1/n_observations)
+        else:
+            assert observation_probs.shape == (n_actions, n_states, n_observations)
+            self.observation_probs = observation_probs
 
     def set_observation(self, action, state, observation, probability):
         self.observation_probs[action, state, observation] = probability
@@ -52,10 +155,14 @@ class ObservationModel:
         return self.observation_probs[action, state, observation]
 
 class RewardModel:
-    def __init__(self, n_states, n_actions):
+    def __init__(self, n_states, n_actions, rewards=None):
         self.n_states = n_states
         self.n_actions = n_actions
-        self.rewards = np.full((n_states, n_actions), -1)
+        if rewards is None:
+            self.rewards = np.full((n_states, n_actions), -1)
+        else:
+            assert rewards.shape == (n_states, n_actions)
+            self.rewards = rewards
 
     def set_reward(self, state, action, reward):
         self.rewards[state, action] = reward
@@ -64,15 +171,48 @@ class RewardModel:
         return self.rewards[state, action]
 
 class POMDPModel:
-    def __init__(self, n_states, n_actions, n_observations):
+    def __init__(
+        self,
+        n_states,
+        n_actions,
+        n_observations,
+        transition_model=None,
+        observation_model=None,
+        reward_model=None,
+        terminal_states=None,
+    ):
+        """
+        Missing models are created uniform (reward -1)
+        * terminal_states: optional boolean mask of the absorbing states
+        """
         self.n_states = n_states
         self.n_actions = n_actions
         self.n_observations = n_observations
 
         # Create transition, observation and reward models
-        self.transition_model = TransitionModel(n_states, n_actions)
-        self.observation_model = ObservationModel(n_states, n_actions, n_observations)
-        self.reward_model = RewardModel(n_states, n_actions)
+        if transition_model is None:
+            transition_model = TransitionModel(n_states, n_actions)
+        if observation_model is None:
+            observation_model = ObservationModel(n_states, n_actions, n_observations)
+        if reward_model is None:
+            reward_model = RewardModel(n_states, n_actions)
+        self.transition_model = transition_model
+        self.observation_model = observation_model
+        self.reward_model = reward_model
+        self.terminal_states = terminal_states
+        # Precomputed simulator tables, see simulator.sampling_tables
+        self.sampling_tables = None
+        # File the model is memory-mapped from, see model_io.load_model
+        self.path = None
+
+    def __reduce_ex__(self, protocol):
+        """
+        A memory-mapped model is sent to other processes as its path,
+        so that they map the same file instead of receiving a copy
+        """
+        if self.path is not None:
+            return _load_model, (self.path,)
+        return super().__reduce_ex__(protocol)
 
     @property
     def get_nb_states(self):
@@ -98,6 +238,10 @@ class POMDPModel:
     def get_observation_model(self):
         return self.observation_model
 
+def _load_model(path):
+    from model_io import load_model
+    return load_model(path)
+
 def make_pomdp_model():
     # +1 in n_observations for the goal observation
     return POMDPModel(config.NB_STATES, len(config.ACTIONS), len(config.POSSIBLE_COLORS)+1)
@@ -0,0 +1,93 @@
+from typing import Dict
+
+import config
+
+"""
+Optional pygame renderer for the Grid.
+* pygame is only imported when a renderer is created.
+* The font and the state number labels are rendered once and cached.
+"""
+
+class GridRenderer(object):
+    def __init__(self, width: int, height: int, tile_size: int, blocking: bool=True) -> None:
+        """
+        * blocking: wait for "q" after every frame (interactive runs),
+        otherwise draw and return immediately
+        """
+        import pygame
+        self.pygame = pygame
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.blocking = blocking
+
+        pygame.init()
+        # In the + 100 you have to display agent belief where he is vs really where he is
+        self.screen = pygame.display.set_mode((self.width, self.height+100))
+        self.screen.fill((255, 255, 255))
+        pygame.display.set_caption(("POMDP GRID"))
+        self.clock = pygame.time.Clock()
+        self.font = pygame.font.Font('freesansbold.ttf', 32)
+        self.labels: Dict[int, object] = {}
+
+    def _get_label(self, state: int):
+        label = self.labels.get(state)
+        if label is None:
+            label = self.labels[state] = self.font.render(str(state), True, config.BLACK_COLOR)
+        return label
+
+    def _draw_cell(self, cell) -> None:
+        pygame = self.pygame
+        pos_x, pos_y = cell.x*self.tile_size, cell.y*self.tile_size
+        pygame.draw.rect(
+            self.screen,
+            cell.color,
+            (pos_x, pos_y, self.tile_size, self.tile_size),
+        )
+        pygame.draw.rect(
+            self.screen,
+            config.BLACK_COLOR,
+            (pos_x, pos_y, self.tile_size, self.tile_size),
+            2,
+        )
+        label = self._get_label(cell.state)
+        self.screen.blit(label, label.get_rect(center=(pos_x+self.tile_size//2, pos_y+self.tile_size//2)))
+
+    def _draw_agent(self, agent_x: int, agent_y: int) -> None:
+        pos_x, pos_y = agent_x*self.tile_size, agent_y*self.tile_size
+        self.pygame.draw.circle(
+            self.screen,
+            config.AGENT_COLOR,
+            (pos_x + self.tile_size // 2, pos_y + self.tile_size // 2),
+            self.tile_size // 4
+        )
+
+    def _wait_for_quit(self) -> None:
+        pygame = self.pygame
+        running = True
+        while running:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    print("Exiting")
+                    running = False
+                # Quit if we click on "q"
+                elif event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_q:
+                        print("Exiting")
+                        running = False
+            pygame.display.flip()
+            self.clock.tick(30)
+
+    def draw(self, grid) -> None:
+        for cell in grid.cells:
+            self._draw_cell(cell)
+        self._draw_agent(grid.agent_x, grid.agent_y)
+        if self.blocking:
+            self._wait_for_quit()
+        else:
+            # Keep the window responsive without waiting
+            self.pygame.event.pump()
+            self.pygame.display.flip()
+
+    def close(self) -> None:
+        self.pygame.quit()
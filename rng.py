@@ -0,0 +1,75 @@
+import math
+import numpy as np
+from typing import List, Tuple, Union
+
+"""
+Random number plumbing.
+* Components draw from an explicit np.random.Generator, nothing uses
+the global random or np.random state.
+* Independent streams (workers, episodes) are spawned from one
+SeedSequence, so a whole run is reproduced from a single seed.
+* UniformBlock pre-draws uniforms by blocks for the hot loops that
+draw a few numbers at a time.
+"""
+
+Seed = Union[None, int, np.random.SeedSequence, np.random.Generator]
+
+def make_rng(seed: Seed=None) -> np.random.Generator:
+    """
+    Generators are passed through, anything else seeds a new one
+    """
+    if isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.default_rng(seed)
+
+def spawn_seeds(seed: Seed, n: int) -> List[np.random.SeedSequence]:
+    """
+    n independent child seeds
+    """
+    if isinstance(seed, np.random.Generator):
+        return seed.bit_generator.seed_seq.spawn(n)
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed.spawn(n)
+
+def spawn_rngs(seed: Seed, n: int) -> List[np.random.Generator]:
+    return [np.random.default_rng(child) for child in spawn_seeds(seed, n)]
+
+class UniformBlock(object):
+    """
+    Uniforms on [0, 1) served from a block drawn at once.
+    * Not thread safe: give every thread its own block.
+    """
+    def __init__(self, rng: np.random.Generator=None, block_size: int=4096) -> None:
+        self.rng = make_rng(rng)
+        self.block_size = block_size
+        self.block = self.rng.random(block_size)
+        self.index = 0
+
+    def take(self, shape: Union[int, Tuple]) -> np.ndarray:
+        """
+        Array of uniforms, read-only view of the block
+        """
+        n = shape if isinstance(shape, int) else math.prod(shape)
+        if n > self.block_size:
+            return self.rng.random(shape)
+        if self.index + n > self.block_size:
+            self.block = self.rng.random(self.block_size)
+            self.index = 0
+        uniforms = self.block[self.index:self.index + n]
+        self.index += n
+        return uniforms.reshape(shape)
+
+    def random(self) -> float:
+        if self.index == self.block_size:
+            self.block = self.rng.random(self.block_size)
+            self.index = 0
+        uniform = self.block[self.index]
+        self.index += 1
+        return float(uniform)
+
+    def integers(self, high: int) -> int:
+        """
+        Uniform integer in [0, high)
+        """
+        return int(self.random()*high)
@@ -0,0 +1,181 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+
+from simulator import Simulator
+from rng import UniformBlock, make_rng
+
+"""
+Vectorized rollouts: K playouts from a leaf are stepped together as
+arrays of states, one simulator call per depth.
+* Returns are accumulated in a vector.
+* Trajectories reaching a terminal state are masked out.
+* An optional LeafValueCache memoizes leaf values per (state, remaining depth).
+"""
+
+class RolloutPolicy(object):
+    """
+    Uniform random policy, base class of the rollout policies.
+    Policies map a batch of states to a batch of actions.
+    """
+    def __init__(self, n_actions: int, rng: np.random.Generator=None) -> None:
+        self.n_actions = n_actions
+        self.set_rng(rng)
+
+    def set_rng(self, rng: np.random.Generator) -> None:
+        self.rng = make_rng(rng)
+        self.uniforms = UniformBlock(self.rng)
+
+    def __call__(self, states: np.ndarray, depth: int) -> np.ndarray:
+        return (self.uniforms.take(states.shape)*self.n_actions).astype(np.int64)
+
+class GreedyRolloutPolicy(RolloutPolicy):
+    """
+    Epsilon-greedy on the immediate reward R(s, a),
+    ties broken at random
+    """
+    def __init__(self, rewards: np.ndarray, epsilon: float=0.2, rng: np.random.Generator=None) -> None:
+        super().__init__(rewards.shape[1], rng)
+        self.rewards = rewards
+        self.epsilon = epsilon
+
+    def __call__(self, states: np.ndarray, depth: int) -> np.ndarray:
+        rewards = self.rewards[states]
+        noise = self.uniforms.take(rewards.shape)
+        greedy = np.argmax(np.where(rewards == rewards.max(axis=-1, keepdims=True), noise, -1.), axis=-1)
+        explore = self.uniforms.take(states.shape) < self.epsilon
+        return np.where(explore, super().__call__(states, depth), greedy)
+
+class LeafValueCache(object):
+    """
+    LRU cache of the running mean rollout return per (state, remaining depth).
+    * Entries with min_samples returns answer directly, except with
+    probability refresh_rate where a fresh playout is blended in.
+    * Thread safe, shared by the tree-parallel workers.
+    """
+    def __init__(
+        self,
+        capacity: int=65536,
+        min_samples: int=16,
+        refresh_rate: float=0.1,
+        rng: np.random.Generator=None,
+    ) -> None:
+        self.capacity = capacity
+        self.min_samples = min_samples
+        self.refresh_rate = refresh_rate
+        self.set_rng(rng)
+        # (state, remaining depth) -> [number of returns, mean return]
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def set_rng(self, rng: np.random.Generator) -> None:
+        self.rng = make_rng(rng)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def lookup(self, state: int, remaining_depth: int) -> float:
+        """
+        Cached value, None when a fresh playout is needed
+        """
+        with self.lock:
+            entry = self.entries.get((state, remaining_depth))
+            if entry is None or entry[0] < self.min_samples or self.rng.random() < self.refresh_rate:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((state, remaining_depth))
+            self.hits += 1
+            return entry[1]
+
+    def add(self, state: int, remaining_depth: int, value: float) -> float:
+        """
+        Blends a fresh return into the running mean and returns the mean
+        """
+        key = (state, remaining_depth)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = [0, 0.]
+                if len(self.entries) > self.capacity:
+                    self.entries.popitem(last=False)
+            else:
+                self.entries.move_to_end(key)
+            entry[0] += 1
+            entry[1] += (value - entry[1])/entry[0]
+            return entry[1]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+class RolloutEngine(object):
+    def __init__(
+        self,
+        simulator: Simulator,
+        policy: RolloutPolicy,
+        discount_factor: float,
+        max_depth: int,
+        nb_rollouts: int=1,
+        terminal_states: np.ndarray=None,
+        cache: LeafValueCache=None,
+    ) -> None:
+        """
+        * nb_rollouts: playouts averaged per leaf evaluation
+        * terminal_states: boolean mask over states, None if nothing terminates
+        * cache: optional leaf value cache
+        """
+        self.simulator = simulator
+        self.policy = policy
+        self.discount_factor = discount_factor
+        self.max_depth = max_depth
+        self.nb_rollouts = nb_rollouts
+        self.terminal_states = terminal_states
+        self.cache = cache
+
+    def playouts(self, states: np.ndarray, depth: int) -> np.ndarray:
+        """
+        Discounted return of one playout from each state, from depth to max_depth
+        """
+        states = np.array(states, dtype=np.int64)
+        returns = np.zeros(states.shape)
+        alive = np.ones(states.shape, dtype=bool)
+        if self.terminal_states is not None:
+            alive &= ~self.terminal_states[states]
+        discount = 1.
+        for current_depth in range(depth, self.max_depth):
+            if not alive.any():
+                break
+            actions = self.policy(states, current_depth)
+            next_states, _, rewards = self.simulator.step(states, actions)
+            returns += discount*np.where(alive, rewards, 0.)
+            states = np.where(alive, next_states, states)
+            if self.terminal_states is not None:
+                alive &= ~self.terminal_states[states]
+            discount *= self.discount_factor
+        return returns
+
+    def evaluate(self, state: int, depth: int) -> float:
+        """
+        Mean return of nb_rollouts playouts from state,
+        blended with the cached mean when there is a cache
+        """
+        if self.cache is None:
+            return float(self.playouts(np.full(self.nb_rollouts, state), depth).mean())
+        remaining_depth = self.max_depth - depth
+        value = self.cache.lookup(state, remaining_depth)
+        if value is None:
+            value = self.cache.add(state, remaining_depth,
+                                   float(self.playouts(np.full(self.nb_rollouts, state), depth).mean()))
+        return value
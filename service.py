@@ -0,0 +1,236 @@
+import json
+import asyncio
+import argparse
+import numpy as np
+from typing import Dict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import config
+from grid import Grid
+from agent import POMCPAgent
+from grid_model import compile_grid_model
+from rng import spawn_seeds
+
+"""
+Asyncio planning service.
+* Clients send one JSON request per line over a Unix or TCP socket and
+get one JSON response per line, {"ok": true, ...} or {"ok": false, "error": ...}.
+* Every session keeps a warm headless POMCPAgent and its search tree:
+    * open: creates the session, from a grid seed or a model file
+    * plan: searches (time_out, max_simulations) and returns the best action
+    * act: returns the best action of the warm tree without searching
+    * observe: records the real action, observation and reward
+    * close: drops the session
+* Searches run in a thread pool so sessions are multiplexed, requests
+of one session are served in order.
+* Between requests a session ponders: its tree keeps growing until the
+next request arrives or ponder_time runs out. Ponders run in their own
+bounded thread pool, a request never waits for the ponder of another
+session.
+"""
+
+def make_session_agent(
+    mult_factor: int=config.MULT_FACTOR,
+    seed: int=0,
+    slip: float=0.,
+    model_path: str=None,
+    agent_params: Dict=None,
+) -> POMCPAgent:
+    """
+    Headless agent on the grid of the seed, the grid is the one
+    evaluate.run_episode builds from the same seed
+    """
+    world_seed, agent_seed = spawn_seeds(seed, 2)
+    env = Grid(mult_factor, mult_factor, render=False, rng=world_seed, slip=slip)
+    env.reset()
+    if model_path is not None:
+        from model_io import load_model
+        env.set_pomdp_model(load_model(model_path))
+    else:
+        env.set_pomdp_model(compile_grid_model(env, slip, sparse=True))
+    return POMCPAgent(env, seed=agent_seed, verbose=False, **(agent_params or {}))
+
+def parse_observation(observation) -> tuple:
+    """
+    Observation colour as an RGB list or an index in config.OBSERVATIONS
+    """
+    if isinstance(observation, int):
+        return config.OBSERVATIONS[observation]
+    return tuple(observation)
+
+class Session(object):
+    def __init__(
+        self,
+        agent: POMCPAgent,
+        executor: ThreadPoolExecutor,
+        ponder_time: float,
+        ponder_executor: ThreadPoolExecutor=None,
+    ) -> None:
+        self.agent = agent
+        self.executor = executor
+        self.ponder_time = ponder_time
+        self.ponder_executor = ponder_executor or executor
+        # Serves the requests of the session in order
+        self.lock = asyncio.Lock()
+        self.ponder: Future = None
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def start_pondering(self) -> None:
+        # Root-parallel searches do not grow the agent tree
+        if self.ponder_time > 0 and self.agent.nb_workers == 1 and not self.agent.done:
+            self.ponder = self.ponder_executor.submit(
+                self.agent.search, self.agent.history, self.ponder_time, np.inf
+            )
+
+    async def stop_pondering(self) -> None:
+        if self.ponder is not None:
+            self.agent.stop_event.set()
+            # A ponder still queued behind the others is dropped
+            if not self.ponder.cancel():
+                await asyncio.wrap_future(self.ponder)
+            self.agent.stop_event.clear()
+            self.ponder = None
+
+    @property
+    def root_visits(self) -> int:
+        root = self.agent.search_tree.find(self.agent.history)
+        return int(self.agent.search_tree.tree.nb_visits[root]) if root >= 0 else 0
+
+    async def plan(self, time_out: float=None, max_simulations: int=None) -> Dict:
+        action = await self.run(self.agent.search, self.agent.history, time_out, max_simulations)
+        return {"action": self.agent.env.action_int2str(action), "nb_simulations": self.agent.nb_simulations,
+                "root_visits": self.root_visits}
+
+    async def act(self) -> Dict:
+        action = self.agent.current_best_action()
+        if action is None:
+            return await self.plan()
+        return {"action": action, "nb_simulations": 0, "root_visits": self.root_visits}
+
+    async def observe(self, action: str, observation, reward: float=0., done: bool=False) -> Dict:
+        await self.run(self.agent.observe, action, parse_observation(observation), reward, done)
+        return {"reused_simulations": int(self.agent.reused_simulations)}
+
+    async def close(self) -> None:
+        await self.stop_pondering()
+        self.agent.close()
+
+class PlannerServer(object):
+    def __init__(
+        self,
+        max_workers: int=None,
+        ponder_time: float=10.,
+        agent_params: Dict=None,
+        ponder_workers: int=1,
+    ) -> None:
+        """
+        * max_workers: threads running the searches
+        * ponder_time: maximal search time between two requests, 0 disables pondering
+        * agent_params: default POMCPAgent parameters of the sessions
+        * ponder_workers: threads running the ponders, apart from the searches
+        """
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.ponder_executor = ThreadPoolExecutor(ponder_workers)
+        self.ponder_time = ponder_time
+        self.agent_params = agent_params or {}
+        self.sessions = {}
+        self.server = None
+
+    async def open_session(self, session_id: str, request: Dict) -> Dict:
+        if session_id in self.sessions:
+            raise ValueError(f"Session {session_id} already exists.")
+        agent_params = dict(self.agent_params, **request.get("params", {}))
+        agent = await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            lambda: make_session_agent(request.get("mult_factor", config.MULT_FACTOR), request.get("seed", 0),
+                                       request.get("slip", 0.), request.get("model"), agent_params),
+        )
+        session = self.sessions[session_id] = Session(agent, self.executor, self.ponder_time, self.ponder_executor)
+        session.start_pondering()
+        return {"nb_states": agent.env.get_number_states}
+
+    async def handle_request(self, request: Dict) -> Dict:
+        op, session_id = request.get("op"), request.get("session")
+        if op == "open":
+            return await self.open_session(session_id, request)
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise KeyError(f"Unknown session {session_id}.")
+        async with session.lock:
+            await session.stop_pondering()
+            if op == "close":
+                del self.sessions[session_id]
+                await session.close()
+                return {}
+            if op == "plan":
+                response = await session.plan(request.get("time_out"), request.get("max_simulations"))
+            elif op == "act":
+                response = await session.act()
+            elif op == "observe":
+                response = await session.observe(request["action"], request["observation"],
+                                                 request.get("reward", 0.), request.get("done", False))
+            else:
+                raise ValueError(f"Unknown operation {op}.")
+            session.start_pondering()
+            return response
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = dict(await self.handle_request(json.loads(line)), ok=True)
+                except Exception as error:
+                    response = {"ok": False, "error": f"{type(error).__name__}: {error}"}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, path: str=None, host: str="127.0.0.1", port: int=8765) -> asyncio.AbstractServer:
+        """
+        Listens on the Unix socket path, or on host:port when path is None
+        """
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_connection, path)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for session in list(self.sessions.values()):
+            await session.close()
+        self.sessions.clear()
+        self.executor.shutdown()
+        self.ponder_executor.shutdown()
+
+async def serve(server: PlannerServer, path: str=None, host: str="127.0.0.1", port: int=8765) -> None:
+    await server.start(path, host, port)
+    try:
+        await server.server.serve_forever()
+    finally:
+        await server.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="POMCP planning service")
+    parser.add_argument("--unix", default=None, help="Unix socket path, TCP when omitted")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--ponder-time", type=float, default=10.)
+    parser.add_argument("--ponder-workers", type=int, default=1)
+    parser.add_argument("--time-out", type=float, default=1.)
+    args = parser.parse_args()
+
+    planner_server = PlannerServer(args.workers, args.ponder_time, {"time_out": args.time_out}, args.ponder_workers)
+    try:
+        asyncio.run(serve(planner_server, args.unix, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
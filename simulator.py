@@ -0,0 +1,104 @@
+import numpy as np
+from typing import Tuple
+
+from pomdp import POMDPModel
+from rng import UniformBlock, make_rng
+
+"""
+Side-effect free black-box simulator G(s, a) -> (s', z, r).
+* Transition and observation tables are stored as cumulative
+distributions and sampled by inverse CDF.
+* Rows of each table are laid out back to back, row r shifted by r,
+so a single searchsorted samples a whole batch of rows.
+* Transitions are sampled over the successor slots of the model,
+so sparse models keep the tables linear in the number of states.
+* The tables are cached on the model (sampling_tables): build the
+simulator once the model is final, later set_transition or
+set_observation calls are not seen.
+"""
+
+def _shifted_cdf(probs: np.ndarray) -> np.ndarray:
+    """
+    * probs: (n_rows, n_outcomes) distributions
+    Returns the flat table of cumulative distributions, row r in [r, r+1]
+    """
+    cdf = np.cumsum(probs, axis=1)
+    # Guard against rounding: every row must end exactly at 1
+    cdf /= cdf[:, -1:]
+    return (cdf + np.arange(len(cdf))[:, None]).ravel()
+
+def sampling_tables(pomdp: POMDPModel) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the successor table (None for a dense model) and the
+    shifted transition and observation CDFs
+    * Row s*n_actions + a of the transition tables holds T(s, a, .)
+    over the successor slots
+    * Row a*n_states + s' of the observation CDF holds O(a, s', .)
+    """
+    n_states, n_actions = pomdp.get_nb_states, pomdp.get_nb_actions
+    next_states, transition_probs = pomdp.get_transition_model.successors()
+    n_successors = transition_probs.shape[2]
+    successors = None
+    if next_states is not None:
+        successors = next_states.reshape(n_states*n_actions, n_successors)
+    transition_cdf = _shifted_cdf(transition_probs.reshape(n_states*n_actions, n_successors))
+    observation_probs = pomdp.get_observation_model.observation_probs
+    observation_cdf = _shifted_cdf(observation_probs.reshape(n_actions*n_states, pomdp.get_nb_observations))
+    return successors, transition_cdf, observation_cdf
+
+class Simulator(object):
+    def __init__(self, pomdp: POMDPModel, rng: np.random.Generator=None) -> None:
+        self.n_states = pomdp.get_nb_states
+        self.n_actions = pomdp.get_nb_actions
+        self.n_observations = pomdp.get_nb_observations
+        self.rng = make_rng(rng)
+        self.uniforms = UniformBlock(self.rng)
+
+        if pomdp.sampling_tables is None:
+            pomdp.sampling_tables = sampling_tables(pomdp)
+        self.successors, self.transition_cdf, self.observation_cdf = pomdp.sampling_tables
+        self.n_successors = len(self.transition_cdf)//(self.n_states*self.n_actions)
+        self.rewards = pomdp.get_reward_model.rewards
+
+    def sample_states(self, states: np.ndarray, actions: np.ndarray, uniforms: np.ndarray=None) -> np.ndarray:
+        rows = states*self.n_actions + actions
+        if uniforms is None:
+            uniforms = self.uniforms.take(rows.shape)
+        slots = np.searchsorted(self.transition_cdf, rows + uniforms, side="right") - rows*self.n_successors
+        slots = np.minimum(slots, self.n_successors - 1)
+        if self.successors is None:
+            return slots
+        return self.successors[rows, slots]
+
+    def sample_observations(self, actions: np.ndarray, next_states: np.ndarray, uniforms: np.ndarray=None) -> np.ndarray:
+        rows = actions*self.n_states + next_states
+        if uniforms is None:
+            uniforms = self.uniforms.take(rows.shape)
+        observations = np.searchsorted(self.observation_cdf, rows + uniforms, side="right") - rows*self.n_observations
+        return np.minimum(observations, self.n_observations - 1)
+
+    def step(self, states: np.ndarray, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Steps a whole batch of (state, action) pairs.
+        Returns next states, observations and rewards, as arrays.
+        """
+        states = np.asarray(states, dtype=np.int64)
+        actions = np.broadcast_to(np.asarray(actions, dtype=np.int64), states.shape)
+        uniforms = self.uniforms.take((2,) + states.shape)
+        next_states = self.sample_states(states, actions, uniforms[0])
+        observations = self.sample_observations(actions, next_states, uniforms[1])
+        return next_states, observations, self.rewards[states, actions]
+
+    def __call__(self, state: int, action: int) -> Tuple[int, int, float]:
+        """
+        Single (state, action) step, same contract as the old Generator
+        """
+        state_uniform, observation_uniform = self.uniforms.random(), self.uniforms.random()
+        row = state*self.n_actions + action
+        slot = int(self.transition_cdf.searchsorted(row + state_uniform, side="right")) - row*self.n_successors
+        slot = min(slot, self.n_successors - 1)
+        next_state = slot if self.successors is None else int(self.successors[row, slot])
+        row = action*self.n_states + next_state
+        observation = int(self.observation_cdf.searchsorted(row + observation_uniform, side="right")) - row*self.n_observations
+        observation = min(observation, self.n_observations - 1)
+        return next_state, observation, self.rewards[state, action]
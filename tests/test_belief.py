@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from pomdp import TransitionModel, SparseTransitionModel, ObservationModel
+from belief import BeliefUpdater
+
+"""
+BeliefUpdater against the scalar Bayes filter
+b'(s') ∝ O(a, s', z) * sum_s T(s, a, s') * b(s)
+"""
+
+N_STATES, N_ACTIONS, N_OBSERVATIONS, N_SUCCESSORS = 12, 3, 4, 4
+
+def reference_update(transition_probs, observation_probs, belief, action, observation):
+    posterior = np.zeros(len(belief))
+    for next_state in range(len(belief)):
+        predicted = 0.
+        for state in range(len(belief)):
+            predicted += transition_probs[state, action, next_state]*belief[state]
+        posterior[next_state] = observation_probs[action, next_state, observation]*predicted
+    return posterior/posterior.sum()
+
+def random_models(sparse: bool, seed: int=0):
+    rng = np.random.default_rng(seed)
+    next_states = np.stack([
+        rng.choice(N_STATES, size=N_SUCCESSORS, replace=False)
+        for _ in range(N_STATES*N_ACTIONS)
+    ]).reshape(N_STATES, N_ACTIONS, N_SUCCESSORS)
+    probs = rng.dirichlet(np.ones(N_SUCCESSORS), size=(N_STATES, N_ACTIONS))
+    transition_model = SparseTransitionModel(N_STATES, N_ACTIONS, next_states, probs)
+    if not sparse:
+        transition_model = TransitionModel(N_STATES, N_ACTIONS, transition_model.to_dense())
+    observation_probs = rng.dirichlet(np.ones(N_OBSERVATIONS), size=(N_ACTIONS, N_STATES))
+    observation_model = ObservationModel(N_STATES, N_ACTIONS, N_OBSERVATIONS, observation_probs)
+    return transition_model, observation_model
+
+def random_beliefs(n: int, seed: int=1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    beliefs = rng.dirichlet(np.ones(N_STATES), size=n)
+    # Beliefs with a partial support
+    beliefs[::2, :N_STATES//2] = 0.
+    return beliefs/beliefs.sum(axis=1, keepdims=True)
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_update_matches_reference(sparse):
+    transition_model, observation_model = random_models(sparse)
+    transition_probs = transition_model.to_dense() if sparse else transition_model.transition_probs
+    updater = BeliefUpdater(transition_model, observation_model)
+    for belief in random_beliefs(6):
+        for action in range(N_ACTIONS):
+            for observation in range(N_OBSERVATIONS):
+                expected = reference_update(transition_probs, observation_model.observation_probs,
+                                            belief, action, observation)
+                np.testing.assert_allclose(updater.update(belief, action, observation), expected,
+                                           rtol=1e-12, atol=1e-15)
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_update_batch_matches_reference(sparse):
+    transition_model, observation_model = random_models(sparse)
+    transition_probs = transition_model.to_dense() if sparse else transition_model.transition_probs
+    updater = BeliefUpdater(transition_model, observation_model)
+    rng = np.random.default_rng(2)
+    beliefs = random_beliefs(20)
+    actions = rng.integers(N_ACTIONS, size=len(beliefs))
+    observations = rng.integers(N_OBSERVATIONS, size=len(beliefs))
+    expected = np.stack([
+        reference_update(transition_probs, observation_model.observation_probs, belief, action, observation)
+        for belief, action, observation in zip(beliefs, actions, observations)
+    ])
+    np.testing.assert_allclose(updater.update_batch(beliefs, actions, observations), expected,
+                               rtol=1e-12, atol=1e-15)
+
+def test_impossible_observation_raises():
+    transition_model, observation_model = random_models(False)
+    observation_model.observation_probs[0, :, 0] = 0.
+    updater = BeliefUpdater(transition_model, observation_model)
+    with pytest.raises(ValueError):
+        updater.update(random_beliefs(1)[0], 0, 0)
@@ -0,0 +1,157 @@
+import numpy as np
+import pytest
+
+from pomdp import POMDPModel, SparseTransitionModel, ObservationModel, RewardModel
+from simulator import Simulator
+from belief import ParticleBelief
+from kernel import SearchKernel
+from tree import ArrayTree, NO_NODE, extend_history_hash
+
+"""
+SearchKernel against a recursive search over the same ArrayTree
+methods, fed the same uniforms (see the kernel uniform layout).
+Runs as plain NumPy when Numba is not installed.
+"""
+
+N_STATES, N_ACTIONS, N_OBSERVATIONS, N_SUCCESSORS = 6, 3, 4, 3
+MAX_DEPTH, DISCOUNT, UCB_CST = 4, 0.95, 2.
+
+def small_model(seed: int=0) -> POMDPModel:
+    rng = np.random.default_rng(seed)
+    next_states = np.stack([
+        rng.choice(N_STATES, size=N_SUCCESSORS, replace=False)
+        for _ in range(N_STATES*N_ACTIONS)
+    ]).reshape(N_STATES, N_ACTIONS, N_SUCCESSORS)
+    probs = rng.dirichlet(np.ones(N_SUCCESSORS), size=(N_STATES, N_ACTIONS))
+    observation_probs = rng.dirichlet(np.ones(N_OBSERVATIONS), size=(N_ACTIONS, N_STATES))
+    terminal_states = np.zeros(N_STATES, dtype=bool)
+    terminal_states[-1] = True
+    return POMDPModel(
+        N_STATES, N_ACTIONS, N_OBSERVATIONS,
+        SparseTransitionModel(N_STATES, N_ACTIONS, next_states, probs),
+        ObservationModel(N_STATES, N_ACTIONS, N_OBSERVATIONS, observation_probs),
+        RewardModel(N_STATES, N_ACTIONS, rng.normal(size=(N_STATES, N_ACTIONS))),
+        terminal_states,
+    )
+
+def draw(uniform: float, n: int) -> int:
+    return min(int(uniform*n), n - 1)
+
+class RecursiveSearch(object):
+    """
+    One simulation per row of uniforms, recursion over the ArrayTree
+    methods used by POMCPAgent.simulate
+    """
+    def __init__(self, simulator: Simulator, terminal_states: np.ndarray, action_widening=None,
+                 observation_widening=None) -> None:
+        self.simulator = simulator
+        self.terminal_states = terminal_states
+        self.action_widening = action_widening
+        self.observation_widening = observation_widening
+
+    def step(self, state: int, action: int, state_uniform: float, observation_uniform: float):
+        next_state = int(self.simulator.sample_states(np.array([state]), np.array([action]),
+                                                      np.array([state_uniform]))[0])
+        observation = int(self.simulator.sample_observations(np.array([action]), np.array([next_state]),
+                                                             np.array([observation_uniform]))[0])
+        return next_state, observation, self.simulator.rewards[state, action]
+
+    def rollout(self, state: int, depth: int, draws: np.ndarray) -> float:
+        offset = 1 + 4*MAX_DEPTH
+        ret, discount = 0., 1.
+        for _ in range(depth, MAX_DEPTH):
+            if self.terminal_states[state]:
+                break
+            action = draw(draws[offset], N_ACTIONS)
+            ret += discount*self.simulator.rewards[state, action]
+            state, _, _ = self.step(state, action, draws[offset + 1], 0.)
+            offset += 2
+            discount *= DISCOUNT
+        return ret
+
+    def add_untried_action(self, tree: ArrayTree, node: int, uniform: float) -> None:
+        untried = np.flatnonzero(tree.action_children[node] == NO_NODE)
+        tree.add_action_child(node, int(untried[draw(uniform, len(untried))]))
+
+    def simulate(self, tree: ArrayTree, state: int, node: int, depth: int, draws: np.ndarray) -> float:
+        if depth >= MAX_DEPTH:
+            return 0.
+        if tree.is_leaf(node):
+            if self.action_widening is None:
+                tree.expand(node)
+            else:
+                self.add_untried_action(tree, node, draws[3 + 4*depth])
+            return self.rollout(state, depth, draws)
+        if self.action_widening is not None:
+            k, alpha = self.action_widening
+            if tree.nb_children[node] < N_ACTIONS and tree.nb_children[node] <= k*tree.nb_visits[node]**alpha:
+                self.add_untried_action(tree, node, draws[3 + 4*depth])
+
+        action_node = tree.ucb_select(node, UCB_CST)
+        next_state, observation, reward = self.step(state, int(tree.action[action_node]),
+                                                    draws[1 + 4*depth], draws[2 + 4*depth])
+        next_node = tree.observation_child(action_node, observation)
+        if next_node == NO_NODE and self.observation_widening is not None:
+            k, alpha = self.observation_widening
+            nb_children = tree.nb_children[action_node]
+            if nb_children > 0 and nb_children > k*tree.nb_visits[action_node]**alpha:
+                next_node = tree.sample_observation_child(action_node, draws[4 + 4*depth])
+        if next_node == NO_NODE:
+            next_node = tree.add_observation_child(action_node, observation)
+        ret = reward + DISCOUNT*self.simulate(tree, next_state, next_node, depth + 1, draws)
+        tree.backup(node, action_node, ret)
+        return ret
+
+def statistics(tree: ArrayTree):
+    free = set(tree.free_nodes[:tree.nb_free].tolist())
+    return {
+        int(tree.history_hash[node]): (int(tree.nb_visits[node]), float(tree.value[node]))
+        for node in range(tree.size) if node not in free
+    }
+
+@pytest.mark.parametrize("action_widening", [None, (1., .5)])
+@pytest.mark.parametrize("observation_widening", [None, (1., .3)])
+@pytest.mark.parametrize("max_observation_children", [None, 2])
+def test_kernel_matches_recursive_search(action_widening, observation_widening, max_observation_children):
+    model = small_model()
+    simulator = Simulator(model, 0)
+    kernel = SearchKernel(simulator, model.terminal_states, DISCOUNT, MAX_DEPTH, UCB_CST,
+                          action_widening=action_widening, observation_widening=observation_widening)
+    reference = RecursiveSearch(simulator, model.terminal_states, action_widening, observation_widening)
+    root_states = np.array([0, 1, 2, 3])
+    particles = ParticleBelief()
+    particles.extend(root_states)
+    uniforms = np.random.default_rng(1).random((400, kernel.nb_uniforms))
+
+    trees = [ArrayTree(N_ACTIONS, N_OBSERVATIONS, max_observation_children=max_observation_children)
+             for _ in range(2)]
+    # Two batches, the second one starts from a grown tree
+    kernel._run(trees[0], trees[0].root, particles, uniforms[:150])
+    kernel._run(trees[0], trees[0].root, particles, uniforms[150:])
+    for draws in uniforms:
+        reference.simulate(trees[1], int(root_states[draw(draws[0], len(root_states))]), trees[1].root, 0, draws)
+
+    expected = statistics(trees[1])
+    assert len(expected) > 100
+    assert statistics(trees[0]) == expected
+    if max_observation_children is not None and observation_widening is None:
+        assert trees[0].nb_free > 0
+
+@pytest.mark.parametrize("max_observation_children", [None, 2])
+def test_kernel_hashes_extend_parent_hash(max_observation_children):
+    model = small_model()
+    kernel = SearchKernel(Simulator(model, 0), model.terminal_states, DISCOUNT, MAX_DEPTH, UCB_CST)
+    tree = ArrayTree(N_ACTIONS, N_OBSERVATIONS, root_hash=12345, max_observation_children=max_observation_children)
+    particles = ParticleBelief()
+    particles.extend([0, 1])
+    kernel._run(tree, tree.root, particles, np.random.default_rng(2).random((200, kernel.nb_uniforms)))
+
+    free = set(tree.free_nodes[:tree.nb_free].tolist())
+    for node in range(tree.size):
+        if node == tree.root or node in free:
+            continue
+        parent = tree.parent[node]
+        label = tree.action[node] if tree.action[node] != NO_NODE else tree.observation[node]
+        assert int(tree.history_hash[node]) == extend_history_hash(int(tree.history_hash[parent]), int(label))
+        assert tree.history_index[int(tree.history_hash[node])] == node
+    assert len(tree.history_index) == len(tree)
@@ -0,0 +1,95 @@
+import pickle
+import numpy as np
+import pytest
+
+from pomdp import POMDPModel, TransitionModel, SparseTransitionModel, ObservationModel, RewardModel
+from simulator import Simulator, sampling_tables
+from model_io import save_model, load_model
+
+"""
+model_io save and load round trips
+"""
+
+N_STATES, N_ACTIONS, N_OBSERVATIONS, N_SUCCESSORS = 50, 4, 5, 3
+
+def random_model(sparse: bool, terminal: bool=True, seed: int=0) -> POMDPModel:
+    rng = np.random.default_rng(seed)
+    next_states = rng.integers(N_STATES, size=(N_STATES, N_ACTIONS, N_SUCCESSORS))
+    probs = rng.dirichlet(np.ones(N_SUCCESSORS), size=(N_STATES, N_ACTIONS))
+    transition_model = SparseTransitionModel(N_STATES, N_ACTIONS, next_states, probs)
+    if not sparse:
+        transition_model = TransitionModel(N_STATES, N_ACTIONS, transition_model.to_dense())
+    observation_probs = rng.dirichlet(np.ones(N_OBSERVATIONS), size=(N_ACTIONS, N_STATES))
+    terminal_states = rng.random(N_STATES) < 0.1 if terminal else None
+    return POMDPModel(
+        N_STATES, N_ACTIONS, N_OBSERVATIONS,
+        transition_model,
+        ObservationModel(N_STATES, N_ACTIONS, N_OBSERVATIONS, observation_probs),
+        RewardModel(N_STATES, N_ACTIONS, rng.normal(size=(N_STATES, N_ACTIONS))),
+        terminal_states,
+    )
+
+def assert_same_model(model: POMDPModel, expected: POMDPModel) -> None:
+    assert (model.get_nb_states, model.get_nb_actions, model.get_nb_observations) \
+        == (expected.get_nb_states, expected.get_nb_actions, expected.get_nb_observations)
+    transition_model, expected_transition_model = model.get_transition_model, expected.get_transition_model
+    assert type(transition_model) is type(expected_transition_model)
+    if isinstance(expected_transition_model, SparseTransitionModel):
+        np.testing.assert_array_equal(transition_model.next_states, expected_transition_model.next_states)
+        np.testing.assert_array_equal(transition_model.probs, expected_transition_model.probs)
+    else:
+        np.testing.assert_array_equal(transition_model.transition_probs, expected_transition_model.transition_probs)
+    np.testing.assert_array_equal(model.get_observation_model.observation_probs,
+                                  expected.get_observation_model.observation_probs)
+    np.testing.assert_array_equal(model.get_reward_model.rewards, expected.get_reward_model.rewards)
+    if expected.terminal_states is None:
+        assert model.terminal_states is None
+    else:
+        np.testing.assert_array_equal(model.terminal_states, expected.terminal_states)
+    for table, expected_table in zip(model.sampling_tables, sampling_tables(expected)):
+        if expected_table is None:
+            assert table is None
+        else:
+            np.testing.assert_array_equal(table, expected_table)
+
+@pytest.mark.parametrize("mmap", [True, False])
+@pytest.mark.parametrize("terminal", [True, False])
+@pytest.mark.parametrize("sparse", [False, True])
+def test_round_trip(tmp_path, sparse, terminal, mmap):
+    model = random_model(sparse, terminal)
+    path = str(tmp_path/"model.pomdp")
+    save_model(model, path)
+    loaded = load_model(path, mmap=mmap)
+    assert_same_model(loaded, model)
+    assert loaded.path == (path if mmap else None)
+    assert isinstance(loaded.get_observation_model.observation_probs, np.memmap) == mmap
+    # Same draws from the same seed
+    states = np.arange(N_STATES).repeat(N_ACTIONS)
+    actions = np.tile(np.arange(N_ACTIONS), N_STATES)
+    for expected, result in zip(Simulator(model, 0).step(states, actions), Simulator(loaded, 0).step(states, actions)):
+        np.testing.assert_array_equal(result, expected)
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_mapped_model_is_pickled_as_its_path(tmp_path, sparse):
+    model = random_model(sparse)
+    path = str(tmp_path/"model.pomdp")
+    save_model(model, path)
+
+    mapped = pickle.dumps(load_model(path))
+    assert path.encode() in mapped
+    assert len(mapped) < model.get_observation_model.observation_probs.nbytes
+    unpickled = pickle.loads(mapped)
+    assert unpickled.path == path
+    assert isinstance(unpickled.get_reward_model.rewards, np.memmap)
+    assert_same_model(unpickled, model)
+
+    # A model read in memory is pickled with its arrays
+    copied = pickle.loads(pickle.dumps(load_model(path, mmap=False)))
+    assert copied.path is None
+    assert_same_model(copied, model)
+
+def test_load_rejects_other_files(tmp_path):
+    path = tmp_path/"model.npz"
+    np.savez(path, probs=np.ones(3))
+    with pytest.raises(ValueError):
+        load_model(str(path))
@@ -0,0 +1,48 @@
+import numpy as np
+
+from plan_cache import PlanCache, belief_key
+
+def uniform_over(n_states: int, support: np.ndarray) -> np.ndarray:
+    belief = np.zeros(n_states)
+    belief[support] = 1/len(support)
+    return belief
+
+def test_diffuse_beliefs_have_distinct_keys():
+    full = np.full(2500, 1/2500)
+    partial = uniform_over(2500, np.arange(2000))
+    shifted = uniform_over(2500, np.arange(500, 2500))
+    keys = {belief_key(full), belief_key(partial), belief_key(shifted)}
+    assert len(keys) == 3
+
+def test_state_count_is_part_of_the_key():
+    assert belief_key(np.full(4, .25)) != belief_key(np.r_[np.full(4, .25), 0.])
+
+def test_same_belief_shares_its_key():
+    rng = np.random.default_rng(0)
+    belief = rng.dirichlet(np.ones(50))
+    noisy = belief*(1 + 1e-9*rng.standard_normal(50))
+    assert belief_key(belief) == belief_key(noisy/noisy.sum())
+
+def test_diffuse_beliefs_miss_each_other():
+    cache = PlanCache(skip_visits=10)
+    full = np.full(2500, 1/2500)
+    partial = uniform_over(2500, np.arange(2000))
+    cache.store(full, np.array([20, 0]), np.array([-1., -5.]))
+    assert cache.lookup(partial) is None
+    cache.store(partial, np.array([0, 20]), np.array([-5., -1.]))
+    visits, values = cache.lookup(full)
+    np.testing.assert_array_equal(visits, [20, 0])
+    visits, values = cache.lookup(partial)
+    np.testing.assert_array_equal(visits, [0, 20])
+
+def test_save_load_round_trip(tmp_path):
+    cache = PlanCache()
+    beliefs = np.random.default_rng(1).dirichlet(np.ones(8), size=3)
+    for i, belief in enumerate(beliefs):
+        cache.store(belief, np.arange(4) + i, np.linspace(-1, 0, 4))
+    path = str(tmp_path/"plans.npz")
+    cache.save(path)
+    loaded = PlanCache.load(path)
+    for i, belief in enumerate(beliefs):
+        visits, _ = loaded.lookup(belief)
+        np.testing.assert_array_equal(visits, np.arange(4) + i)
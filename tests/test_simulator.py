@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+
+from pomdp import POMDPModel, TransitionModel, SparseTransitionModel, ObservationModel
+from simulator import Simulator
+
+"""
+Simulator sampling against the transition and observation models
+"""
+
+N_STATES, N_ACTIONS, N_OBSERVATIONS, N_SUCCESSORS = 8, 3, 4, 4
+
+def random_model(sparse: bool, seed: int=0) -> POMDPModel:
+    rng = np.random.default_rng(seed)
+    next_states = np.stack([
+        rng.choice(N_STATES, size=N_SUCCESSORS, replace=False)
+        for _ in range(N_STATES*N_ACTIONS)
+    ]).reshape(N_STATES, N_ACTIONS, N_SUCCESSORS)
+    probs = rng.dirichlet(np.ones(N_SUCCESSORS), size=(N_STATES, N_ACTIONS))
+    # Zero probability slots, leading ones included
+    probs[::2, :, 0] = 0.
+    probs[1::3, :, 2] = 0.
+    probs /= probs.sum(axis=2, keepdims=True)
+    transition_model = SparseTransitionModel(N_STATES, N_ACTIONS, next_states, probs)
+    if not sparse:
+        transition_model = TransitionModel(N_STATES, N_ACTIONS, transition_model.to_dense())
+    observation_probs = rng.dirichlet(np.ones(N_OBSERVATIONS), size=(N_ACTIONS, N_STATES))
+    observation_probs[:, ::2, 0] = 0.
+    observation_probs /= observation_probs.sum(axis=2, keepdims=True)
+    return POMDPModel(N_STATES, N_ACTIONS, N_OBSERVATIONS, transition_model,
+                      ObservationModel(N_STATES, N_ACTIONS, N_OBSERVATIONS, observation_probs))
+
+def dense_transitions(model: POMDPModel) -> np.ndarray:
+    transition_model = model.get_transition_model
+    if isinstance(transition_model, SparseTransitionModel):
+        return transition_model.to_dense()
+    return transition_model.transition_probs
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_sampled_frequencies_match_models(sparse):
+    model = random_model(sparse)
+    simulator = Simulator(model, 0)
+    transition_probs = dense_transitions(model)
+    observation_probs = model.get_observation_model.observation_probs
+    # Evenly spread uniforms: the frequencies are exact up to 1/n
+    n = 4000
+    uniforms = (np.arange(n) + 0.5)/n
+    for state in range(N_STATES):
+        for action in range(N_ACTIONS):
+            next_states = simulator.sample_states(np.full(n, state), np.full(n, action), uniforms)
+            frequencies = np.bincount(next_states, minlength=N_STATES)/n
+            np.testing.assert_allclose(frequencies, transition_probs[state, action], atol=1.5/n)
+            assert np.all(frequencies[transition_probs[state, action] == 0.] == 0.)
+    for action in range(N_ACTIONS):
+        for next_state in range(N_STATES):
+            observations = simulator.sample_observations(np.full(n, action), np.full(n, next_state), uniforms)
+            frequencies = np.bincount(observations, minlength=N_OBSERVATIONS)/n
+            np.testing.assert_allclose(frequencies, observation_probs[action, next_state], atol=1.5/n)
+            assert np.all(frequencies[observation_probs[action, next_state] == 0.] == 0.)
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_random_steps_match_models(sparse):
+    model = random_model(sparse)
+    simulator = Simulator(model, 1)
+    transition_probs = dense_transitions(model)
+    n = 20000
+    state, action = 2, 1
+    next_states, observations, rewards = simulator.step(np.full(n, state), action)
+    frequencies = np.bincount(next_states, minlength=N_STATES)/n
+    # Five standard deviations
+    tolerance = 5*np.sqrt(transition_probs[state, action]*(1 - transition_probs[state, action])/n) + 1e-12
+    assert np.all(np.abs(frequencies - transition_probs[state, action]) <= tolerance)
+    assert np.all(rewards == model.get_reward_model.rewards[state, action])
+    # Observations given each sampled next state
+    observation_probs = model.get_observation_model.observation_probs
+    for next_state in np.flatnonzero(transition_probs[state, action] > 0.2):
+        selected = observations[next_states == next_state]
+        frequencies = np.bincount(selected, minlength=N_OBSERVATIONS)/len(selected)
+        expected = observation_probs[action, next_state]
+        tolerance = 5*np.sqrt(expected*(1 - expected)/len(selected)) + 1e-12
+        assert np.all(np.abs(frequencies - expected) <= tolerance)
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_single_step_matches_batch(sparse):
+    model = random_model(sparse)
+    single, batch = Simulator(model, 2), Simulator(model, 2)
+    rng = np.random.default_rng(3)
+    for state, action in zip(rng.integers(N_STATES, size=500), rng.integers(N_ACTIONS, size=500)):
+        next_states, observations, rewards = batch.step(np.array([state]), action)
+        assert single(int(state), int(action)) == (next_states[0], observations[0], rewards[0])
+
+def test_cdf_boundaries():
+    # Probabilities that are exact in binary, so the CDF steps are exact
+    transition_probs = np.zeros((3, 1, 3))
+    transition_probs[0, 0] = [.25, .25, .5]
+    transition_probs[1, 0] = [0., .5, .5]
+    transition_probs[2, 0] = [.5, 0., .5]
+    observation_probs = np.tile([0., .75, .25], (1, 3, 1))
+    model = POMDPModel(3, 1, 3, TransitionModel(3, 1, transition_probs), ObservationModel(3, 1, 3, observation_probs))
+    simulator = Simulator(model, 0)
+    below_one = np.nextafter(1., 0.)
+
+    def sample(state: int, uniform: float) -> int:
+        return int(simulator.sample_states(np.array([state]), np.array([0]), np.array([uniform]))[0])
+
+    # A uniform on a CDF step goes to the next outcome (side="right")
+    assert [sample(0, u) for u in (0., .25 - 1e-12, .25, .5, below_one)] == [0, 0, 1, 2, 2]
+    # Zero probability slots are skipped, leading ones included
+    assert [sample(1, u) for u in (0., .5)] == [1, 2]
+    assert [sample(2, u) for u in (0., .5 - 1e-12, .5)] == [0, 0, 2]
+    observations = simulator.sample_observations(np.zeros(3, dtype=np.int64), np.arange(3), np.zeros(3))
+    assert np.all(observations == 1)
+    # row + uniform rounds up to row + 1 past row 0, the clamp keeps the last slot
+    assert sample(1, below_one) == sample(2, below_one) == 2
+    observations = simulator.sample_observations(np.zeros(3, dtype=np.int64), np.arange(3), np.full(3, below_one))
+    assert np.all(observations == 2)
@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+
+from grid import Grid
+from grid_model import compile_grid_model
+from agent import POMCPAgent
+from tree import ArrayTree, History, NO_NODE, extend_history_hash
+
+"""
+ArrayTree links, hashes and index after searches and reroots
+"""
+
+def make_agent(kernel: bool, **agent_params) -> POMCPAgent:
+    env = Grid(4, 4, render=False, rng=0)
+    env.reset()
+    # Noisy observations, so the capped action nodes evict branches
+    env.set_pomdp_model(compile_grid_model(env, 0.1, 0.3, sparse=True))
+    return POMCPAgent(env, seed=0, verbose=False, max_simulations=300, time_out=100., max_depth=6,
+                      kernel=kernel, **agent_params)
+
+def free_mask(tree: ArrayTree) -> np.ndarray:
+    free = np.zeros(tree.size, dtype=bool)
+    free[tree.free_nodes[:tree.nb_free]] = True
+    assert free.sum() == tree.nb_free
+    return free
+
+def check_invariants(tree: ArrayTree) -> None:
+    free = free_mask(tree)
+    assert not free[tree.root] and tree.parent[tree.root] == NO_NODE
+    for node in np.flatnonzero(~free).tolist():
+        if node != tree.root:
+            parent = tree.parent[node]
+            assert parent != NO_NODE and not free[parent]
+            if tree.action[node] != NO_NODE:
+                assert tree.action_children[parent, tree.action[node]] == node
+                label = tree.action[node]
+            else:
+                assert node in tree.observation_children[parent].tolist()
+                label = tree.observation[node]
+            assert tree.history_hash[node] == extend_history_hash(int(tree.history_hash[parent]), int(label))
+        children = tree.action_children[node] if tree.action[node] == NO_NODE \
+            else tree.observation_children[node]
+        children = children[children != NO_NODE]
+        assert len(children) == tree.nb_children[node]
+        assert np.all(tree.parent[children] == node)
+        assert tree.history_index[int(tree.history_hash[node])] == node
+    assert len(tree.history_index) == len(tree)
+    for node_hash, node in tree.history_index.items():
+        assert not free[node] and int(tree.history_hash[node]) == node_hash
+    assert not any(free[node] for node in tree.particles)
+
+def most_visited_grandchild(tree: ArrayTree):
+    root = tree.root
+    action_node = tree.action_children[root][np.argmax(tree.nb_visits[tree.action_children[root]])]
+    children = tree.observation_children[action_node]
+    children = children[children != NO_NODE]
+    node = children[np.argmax(tree.nb_visits[children])]
+    return int(node), int(tree.action[action_node]), int(tree.observation[node])
+
+def subtree_statistics(tree: ArrayTree, node: int):
+    return {
+        int(tree.history_hash[kept]): (
+            int(tree.nb_visits[kept]),
+            float(tree.value[kept]),
+            sorted(tree.particles[kept].get_particles.tolist()) if kept in tree.particles else [],
+        )
+        for kept in np.flatnonzero(tree.subtree(node) & ~free_mask(tree)).tolist()
+    }
+
+@pytest.mark.parametrize("kernel", [False, True])
+@pytest.mark.parametrize("agent_params", [
+    {},
+    {"max_observation_children": 1},
+    {"max_observation_children": 2},
+    {"observation_widening": (1., .3), "max_observation_children": 2},
+])
+def test_reroot_keeps_tree_invariants(kernel, agent_params):
+    agent = make_agent(kernel, **agent_params)
+    tree = agent.search_tree.tree
+    history = History()
+    nb_freed = 0
+    for _ in range(3):
+        agent.search(history)
+        check_invariants(tree)
+        nb_freed += tree.nb_free
+        node, action, observation = most_visited_grandchild(tree)
+        kept = subtree_statistics(tree, node)
+        reused = tree.reroot(node)
+        history.extend([action, observation])
+        check_invariants(tree)
+        assert tree.nb_free == 0 and len(tree) == len(kept)
+        assert tree.root == agent.search_tree.find(history)
+        assert reused == kept[history.hash][0]
+        assert subtree_statistics(tree, tree.root) == kept
+    if "max_observation_children" in agent_params:
+        assert nb_freed > 0
+
+def test_evicted_branch_is_freed_and_reused():
+    tree = ArrayTree(2, 4, max_observation_children=2, max_particles=8)
+    tree.expand(tree.root)
+    action_node = tree.action_child(tree.root, 0)
+    first = tree.add_observation_child(action_node, 0)
+    second = tree.add_observation_child(action_node, 1)
+    tree.expand(first)
+    tree.get_particles(first).add(3)
+    tree.nb_visits[first], tree.nb_visits[second] = 1, 5
+    size = tree.size
+
+    third = tree.add_observation_child(action_node, 2)
+    # first and its two action children are freed, third reuses one of them
+    assert tree.size == size and tree.nb_free == 2 and len(tree) == size - 3 + 1
+    assert third in (first, *tree.action_children[first].tolist())
+    assert tree.observation_child(action_node, 0) == NO_NODE
+    assert tree.observation_child(action_node, 2) == third
+    assert tree.nb_children[action_node] == 2
+    check_invariants(tree)
+
+    tree.expand(third)
+    assert tree.nb_free == 0 and tree.size == size
+    check_invariants(tree)
+    assert tree.reroot(second) == 5
+    check_invariants(tree)
+    assert len(tree) == 1
@@ -0,0 +1,401 @@
+import numpy as np
+from typing import Dict, List
+
+from belief import ParticleBelief
+from rng import UniformBlock
+
+"""
+Struct-of-arrays search tree.
+* Node i is described by the i-th entry of every array.
+* Observation nodes (the root included) have action == NO_NODE.
+* Action nodes have observation == NO_NODE.
+* Children are found in the action_children table, indexed by action,
+and in the observation_children slots: no history is stored in the
+tree and plain array code (search kernel) can walk it.
+* With max_observation_children, action nodes have that many
+observation slots, filled in order. Past it, a new observation evicts
+the least visited one: the nodes of the evicted subtree go to a free
+list and are reused by the next additions, so the tree stays bounded
+within a search. Without it, slots are indexed by observation.
+* Node ids do not follow the depth once freed nodes are reused, the
+root is the only node with no parent besides the free ones.
+* Each node keeps an incremental hash of its full history, indexed
+in history_index for O(1) lookup of a real history.
+* History carries its own rolling hash, so a real history is never
+hashed again from its start.
+"""
+
+NO_NODE = -1
+EMPTY_HISTORY_HASH = 0
+# 64 bits FNV-1a step, computed the same way by the search kernel
+FNV_PRIME = 0x100000001b3
+HASH_MASK = 2**64 - 1
+
+def extend_history_hash(history_hash: int, label: int) -> int:
+    return ((history_hash ^ (label + 1))*FNV_PRIME) & HASH_MASK
+
+def hash_history(history: List, initial_hash: int=EMPTY_HISTORY_HASH) -> int:
+    if isinstance(history, History) and initial_hash == EMPTY_HISTORY_HASH:
+        return history.hash
+    for label in history:
+        initial_hash = extend_history_hash(initial_hash, label)
+    return initial_hash
+
+def best_tried_action(visits: np.ndarray, values: np.ndarray) -> int:
+    """
+    Best valued action among the visited ones, for root statistics where
+    untried actions have a value of 0
+    """
+    return int(np.argmax(np.where(visits > 0, values, -np.inf)))
+
+class History(list):
+    """
+    Append-only list of (action, observation) indices with its rolling
+    hash, updated in O(1) per label
+    """
+    def __init__(self, labels: List=()) -> None:
+        super().__init__()
+        self.hash = EMPTY_HISTORY_HASH
+        self.extend(labels)
+
+    def append(self, label: int) -> None:
+        super().append(label)
+        self.hash = extend_history_hash(self.hash, label)
+
+    def extend(self, labels: List) -> None:
+        for label in labels:
+            self.append(label)
+
+    def __reduce__(self):
+        # Rebuilt from its labels: the list items are otherwise restored
+        # through append before hash exists
+        return History, (list(self),)
+
+class ArrayTree(object):
+    def __init__(
+        self,
+        n_actions: int,
+        n_observations: int,
+        capacity: int=1024,
+        max_nodes: int=None,
+        root_hash: int=EMPTY_HISTORY_HASH,
+        max_observation_children: int=None,
+        max_particles: int=None,
+        uniforms: UniformBlock=None,
+    ) -> None:
+        """
+        * capacity: number of preallocated nodes, doubled when full
+        * max_nodes: hard bound on the tree size (None for no bound)
+        * root_hash: history hash of the root
+        * max_observation_children: observation children per action
+        node (None for one per observation)
+        * max_particles: particles kept per node (None for no bound),
+        uniforms draws the replaced ones
+        """
+        self.max_particles = max_particles
+        self.uniforms = uniforms
+        if max_particles is not None and uniforms is None:
+            self.uniforms = UniformBlock()
+        self.n_actions = n_actions
+        self.n_observations = n_observations
+        self.observation_slots = n_observations
+        if max_observation_children is not None:
+            self.observation_slots = min(n_observations, max_observation_children)
+        self.max_nodes = max_nodes
+        if max_nodes is not None:
+            capacity = min(capacity, max_nodes)
+        self.capacity = max(capacity, n_actions + 1)
+        self.size = 0
+
+        self.nb_visits = np.zeros(self.capacity, dtype=np.int64)
+        self.value = np.zeros(self.capacity, dtype=np.float64)
+        self.parent = np.full(self.capacity, NO_NODE, dtype=np.int64)
+        self.action = np.full(self.capacity, NO_NODE, dtype=np.int64)
+        self.observation = np.full(self.capacity, NO_NODE, dtype=np.int64)
+        self.history_hash = np.zeros(self.capacity, dtype=np.uint64)
+        self.nb_children = np.zeros(self.capacity, dtype=np.int64)
+        # Action children of observation nodes, indexed by action
+        self.action_children = np.full((self.capacity, n_actions), NO_NODE, dtype=np.int64)
+        # Observation children of action nodes, indexed by observation or
+        # in the first nb_children slots when capped
+        self.observation_children = np.full((self.capacity, self.observation_slots), NO_NODE, dtype=np.int64)
+        # Stack of the freed node ids, in its first nb_free entries
+        self.free_nodes = np.full(self.capacity, NO_NODE, dtype=np.int64)
+        self.nb_free = 0
+        self.particles: Dict[int, ParticleBelief] = {}
+        self.history_index: Dict[int, int] = {}
+
+        self.root = self._add_root(root_hash)
+
+    def __len__(self) -> int:
+        """
+        Number of nodes in use
+        """
+        return self.size - self.nb_free
+
+    def __str__(self) -> str:
+        return f"ArrayTree({len(self)}/{self.capacity})"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def _grow(self, needed: int) -> None:
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        if self.max_nodes is not None:
+            capacity = min(capacity, self.max_nodes)
+
+        def grown(array: np.ndarray, fill) -> np.ndarray:
+            new_array = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            new_array[:self.size] = array[:self.size]
+            return new_array
+
+        self.nb_visits = grown(self.nb_visits, 0)
+        self.value = grown(self.value, 0.)
+        self.parent = grown(self.parent, NO_NODE)
+        self.action = grown(self.action, NO_NODE)
+        self.observation = grown(self.observation, NO_NODE)
+        self.history_hash = grown(self.history_hash, 0)
+        self.nb_children = grown(self.nb_children, 0)
+        self.action_children = grown(self.action_children, NO_NODE)
+        self.observation_children = grown(self.observation_children, NO_NODE)
+        self.free_nodes = grown(self.free_nodes, NO_NODE)
+        self.capacity = capacity
+
+    def reserve(self, nb_nodes: int) -> None:
+        """
+        Preallocates room for nb_nodes more nodes, within max_nodes
+        """
+        needed = self.size + nb_nodes
+        if self.max_nodes is not None:
+            needed = min(needed, self.max_nodes)
+        if needed > self.capacity:
+            self._grow(needed)
+
+    def can_add(self, nb_nodes: int=1) -> bool:
+        # Freed nodes are reused first
+        return self.max_nodes is None or self.size + nb_nodes - self.nb_free <= self.max_nodes
+
+    def add_node(self, parent: int, action: int, observation: int, node_hash: int=None) -> int:
+        if not self.can_add():
+            return NO_NODE
+        if node_hash is None:
+            label = action if action != NO_NODE else observation
+            node_hash = extend_history_hash(int(self.history_hash[parent]), label)
+        if self.nb_free > 0:
+            self.nb_free -= 1
+            node = int(self.free_nodes[self.nb_free])
+        else:
+            if self.size == self.capacity:
+                self._grow(self.size + 1)
+            node = self.size
+            self.size += 1
+        self.nb_visits[node] = 0
+        self.value[node] = 0.
+        self.parent[node] = parent
+        self.action[node] = action
+        self.observation[node] = observation
+        self.history_hash[node] = node_hash
+        self.nb_children[node] = 0
+        self.action_children[node] = NO_NODE
+        self.observation_children[node] = NO_NODE
+        self.history_index[node_hash] = node
+        if parent != NO_NODE:
+            self.nb_children[parent] += 1
+        return node
+
+    def _add_root(self, root_hash: int) -> int:
+        return self.add_node(NO_NODE, NO_NODE, NO_NODE, root_hash)
+
+    def expand(self, node: int) -> bool:
+        """
+        Adds one action child per action, False if the tree is full
+        """
+        if not self.can_add(self.n_actions - self.nb_children[node]):
+            return False
+        for action in range(self.n_actions):
+            if self.action_children[node, action] == NO_NODE:
+                self.action_children[node, action] = self.add_node(node, action, NO_NODE)
+        return True
+
+    def add_action_child(self, node: int, action: int) -> int:
+        child = self.add_node(node, action, NO_NODE)
+        if child != NO_NODE:
+            self.action_children[node, action] = child
+        return child
+
+    def add_observation_child(self, action_node: int, observation: int) -> int:
+        """
+        Takes the next free slot, or the slot of the least visited
+        child when they are all used
+        """
+        nb_children = int(self.nb_children[action_node])
+        if self.observation_slots == self.n_observations:
+            slot = observation
+        elif nb_children < self.observation_slots:
+            slot = nb_children
+        else:
+            children = self.observation_children[action_node]
+            slot = int(np.argmin(self.nb_visits[children]))
+            self.free_subtree(int(children[slot]))
+            self.nb_children[action_node] -= 1
+        node = self.add_node(action_node, NO_NODE, observation)
+        if node != NO_NODE:
+            self.observation_children[action_node, slot] = node
+        return node
+
+    def free_subtree(self, node: int) -> None:
+        """
+        Puts node and its descendants on the free list, with their
+        particles and history_index entries dropped.
+        The caller unlinks node from its parent.
+        """
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if self.action[node] == NO_NODE:
+                children = self.action_children[node]
+            else:
+                children = self.observation_children[node]
+            stack.extend(children[children != NO_NODE].tolist())
+            self.parent[node] = NO_NODE
+            node_hash = int(self.history_hash[node])
+            if self.history_index.get(node_hash) == node:
+                del self.history_index[node_hash]
+            self.particles.pop(node, None)
+            self.free_nodes[self.nb_free] = node
+            self.nb_free += 1
+
+    def action_child(self, node: int, action: int) -> int:
+        return int(self.action_children[node, action])
+
+    def observation_child(self, action_node: int, observation: int) -> int:
+        if self.observation_slots == self.n_observations:
+            return int(self.observation_children[action_node, observation])
+        children = self.observation_children[action_node, :self.nb_children[action_node]]
+        found = children[self.observation[children] == observation]
+        return int(found[0]) if len(found) else NO_NODE
+
+    def sample_observation_child(self, action_node: int, uniform: float) -> int:
+        """
+        Existing observation child drawn in proportion to its visits
+        """
+        children = self.observation_children[action_node]
+        children = children[children != NO_NODE]
+        weights = np.cumsum(self.nb_visits[children] + 1)
+        return int(children[np.searchsorted(weights, uniform*weights[-1], side="right")])
+
+    def is_leaf(self, node: int) -> bool:
+        return self.nb_children[node] == 0
+
+    def is_expanded(self, node: int) -> bool:
+        return self.nb_children[node] == self.n_actions
+
+    def get_particles(self, node: int) -> ParticleBelief:
+        particles = self.particles.get(node)
+        if particles is None:
+            particles = self.particles[node] = ParticleBelief(max_size=self.max_particles, uniforms=self.uniforms)
+        return particles
+
+    def find(self, history_hash: int) -> int:
+        """
+        Returns the node whose full history has this hash, NO_NODE if none
+        """
+        return self.history_index.get(history_hash, NO_NODE)
+
+    def ucb_select(self, node: int, ucb_cst: float) -> int:
+        """
+        Returns the action child maximising the UCB1 score,
+        unvisited children first
+        """
+        children = self.action_children[node]
+        if not self.is_expanded(node):
+            children = children[children != NO_NODE]
+        visits = self.nb_visits[children]
+        if np.any(visits == 0):
+            return int(children[np.argmin(visits)])
+        scores = self.value[children] + ucb_cst*np.sqrt(np.log(self.nb_visits[node])/visits)
+        return int(children[np.argmax(scores)])
+
+    def action_statistics(self, node: int):
+        """
+        Visits and values per action, 0 for the actions without a child
+        """
+        children = self.action_children[node]
+        exists = children != NO_NODE
+        visits = np.where(exists, self.nb_visits[children], 0)
+        values = np.where(exists, self.value[children], 0.)
+        return visits, values
+
+    def best_action(self, node: int) -> int:
+        children = self.action_children[node]
+        values = np.where(children != NO_NODE, self.value[children], -np.inf)
+        return int(np.argmax(values))
+
+    def backup(self, node: int, action_node: int, ret: float) -> None:
+        self.nb_visits[node] += 1
+        self.nb_visits[action_node] += 1
+        self.value[action_node] += (ret - self.value[action_node])/self.nb_visits[action_node]
+
+    def subtree(self, node: int) -> np.ndarray:
+        """
+        Boolean mask of the nodes below node (node included).
+        Ancestors are followed level by level, one vectorized pass per depth.
+        """
+        in_subtree = np.zeros(self.size, dtype=bool)
+        ancestors = np.arange(self.size)
+        alive = np.ones(self.size, dtype=bool)
+        while np.any(alive):
+            in_subtree |= alive & (ancestors == node)
+            ancestors = np.where(alive, self.parent[np.maximum(ancestors, 0)], NO_NODE)
+            alive = ancestors != NO_NODE
+        return in_subtree
+
+    def reroot(self, node: int) -> int:
+        """
+        Makes node the new root and frees every node outside its subtree.
+        Kept nodes are compacted to the front of the arrays with their
+        statistics, particles and history hashes.
+        Returns the number of simulations reused from the old tree.
+        """
+        keep = np.flatnonzero(self.subtree(node))
+        # The new root goes first, freed nodes have no parent and are dropped
+        keep = np.concatenate(([node], keep[keep != node]))
+        size = len(keep)
+        new_index = np.full(self.size, NO_NODE, dtype=np.int64)
+        new_index[keep] = np.arange(size)
+
+        def remap(ids: np.ndarray) -> np.ndarray:
+            return np.where(ids == NO_NODE, NO_NODE, new_index[np.maximum(ids, 0)])
+
+        self.nb_visits[:size] = self.nb_visits[keep]
+        self.value[:size] = self.value[keep]
+        self.parent[:size] = remap(self.parent[keep])
+        self.parent[0] = NO_NODE
+        self.action[:size] = self.action[keep]
+        self.observation[:size] = self.observation[keep]
+        self.history_hash[:size] = self.history_hash[keep]
+        self.nb_children[:size] = self.nb_children[keep]
+        self.action_children[:size] = remap(self.action_children[keep])
+        self.observation_children[:size] = remap(self.observation_children[keep])
+        self.particles = {
+            int(new_index[old]): particles
+            for old, particles in self.particles.items()
+            if new_index[old] != NO_NODE
+        }
+        self.history_index = {
+            int(node_hash): index
+            for index, node_hash in enumerate(self.history_hash[:size])
+        }
+        self.size = size
+        self.nb_free = 0
+        self.root = 0
+        return int(self.nb_visits[0])
+
+    def clear(self, root_hash: int=EMPTY_HISTORY_HASH) -> None:
+        self.size = 0
+        self.nb_free = 0
+        self.particles.clear()
+        self.history_index.clear()
+        self.root = self._add_root(root_hash)